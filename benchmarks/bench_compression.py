@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+===============================================================================
+                Antigravity API Server - 压缩基准测试
+===============================================================================
+
+功能：衡量各压缩算法节省的字节数与消耗的 CPU
+
+  response  - 非流式 Claude 响应 (gemini_to_claude 输出)
+  sse       - 流式响应，每个 SSE 事件单独 flush (与 compression.sse 行为一致)
+  upstream  - 长会话的上游请求体 (claude_to_gemini 输出，会话由 transcripts.py 生成)
+
+输出原始大小、压缩后大小、压缩率以及每次压缩的耗时和吞吐。
+
+使用方法：
+  python benchmarks/bench_compression.py
+  python benchmarks/bench_compression.py --turns 200 --repeat 20
+
+===============================================================================
+"""
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main as server  # noqa: E402
+from transcripts import make_gemini_response, make_transcript, text  # noqa: E402
+
+def build_payloads(turns: int) -> dict:
+    """构造三类测试载荷"""
+    rng = random.Random(42)
+    claude_request = make_transcript(seed=42, turns=turns)
+    gemini_response = make_gemini_response(seed=42, text_parts=1, function_calls=1, words_per_part=1500)
+
+    # 抑制 map_model 的日志输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        upstream = json.dumps(server.claude_to_gemini(claude_request, "bench-project")).encode()
+        response = json.dumps(server.gemini_to_claude(gemini_response, "gemini-2.5-pro")).encode()
+
+    events = []
+    for _ in range(400):
+        delta = json.dumps(text(rng, rng.randint(2, 8)))
+        events.append(f'data: {{"type":"content_block_delta","index":0,"delta":{{"type":"text_delta","text":{delta}}}}}\n\n'.encode())
+
+    return {"response": [response], "upstream": [upstream], "sse": events}
+
+def compress_once(encoding: str, chunks: list, flush_each: bool) -> bytes:
+    compressor = server.StreamCompressor(encoding)
+    out = [compressor.compress(chunk, flush=flush_each) for chunk in chunks]
+    out.append(compressor.finish())
+    return b"".join(out)
+
+def main():
+    parser = argparse.ArgumentParser(description="压缩基准测试")
+    parser.add_argument("--turns", type=int, default=100, help="upstream 载荷的历史轮数")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    payloads = build_payloads(args.turns)
+    encodings = list(server.AVAILABLE_ENCODINGS)
+
+    print(f"\n可用算法: {', '.join(encodings)}")
+    print(f"\n{'payload':<10}{'encoding':<14}{'original':>11}{'compressed':>12}{'ratio':>8}{'ms/op':>9}{'MB/s':>9}")
+    print("-" * 73)
+    for name, chunks in payloads.items():
+        original = sum(len(c) for c in chunks)
+        flush_each = name == "sse"
+        rows = [(enc, lambda enc=enc: compress_once(enc, chunks, flush_each)) for enc in encodings]
+        if name == "upstream":
+            # 与 encode_upstream_body 的实际实现一致
+            rows.append(("gzip(upstream)", lambda: gzip.compress(chunks[0], compresslevel=5, mtime=0)))
+        for label, fn in rows:
+            size = len(fn())
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                fn()
+            ms = (time.perf_counter() - start) * 1000 / args.repeat
+            print(f"{name:<10}{label:<14}{original:>11}{size:>12}{original / size:>7.1f}x{ms:>9.2f}{original / 1e6 / (ms / 1000):>9.1f}")
+    print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+===============================================================================
+                Antigravity API Server - 服务器 Profile 基准测试
+===============================================================================
+
+功能：对比不同 server profile 的 HTTP 层开销
+
+  default   - uvicorn.run(app, host="0.0.0.0", port=PORT) (原有启动方式)
+  fast      - fast profile，TCP 监听
+  fast-uds  - fast profile，Unix domain socket 监听
+
+每个 profile 启动一个独立的 main.py 进程，用并发 keep-alive 连接压测
+/health (不访问上游，只测量服务器本身的开销)，输出吞吐和延迟分位数。
+
+使用方法：
+  python benchmarks/bench_server.py
+  python benchmarks/bench_server.py --requests 20000 --concurrency 64 --profiles default,fast-uds
+
+===============================================================================
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 18765
+
+def start_server(profile: str, workdir: str) -> tuple:
+    """以指定 profile 启动 main.py，返回 (进程, Unix socket 路径或 None)"""
+    with open(os.path.join(ROOT, "config.json")) as f:
+        config = json.load(f)
+    config["port"] = PORT
+    config["state_db"] = os.path.join(workdir, "state.db")
+    config["server"] = {"profile": "fast" if profile.startswith("fast") else "default"}
+    uds = None
+    if profile.endswith("-uds"):
+        uds = os.path.join(workdir, "bench.sock")
+        config["server"]["uds"] = uds
+
+    config_path = os.path.join(workdir, f"config-{profile}.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    env = dict(os.environ, ANTIGRAVITY_CONFIG=config_path, ANTIGRAVITY_WORKERS="1")
+    for key in ("ANTIGRAVITY_PROFILE", "ANTIGRAVITY_UDS"):
+        env.pop(key, None)
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return proc, uds
+
+REQUEST = b"GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n"
+
+async def open_connection(uds):
+    if uds:
+        return await asyncio.open_unix_connection(uds)
+    return await asyncio.open_connection("127.0.0.1", PORT)
+
+async def fetch_health(reader, writer) -> int:
+    """在 keep-alive 连接上发送一次 GET /health，返回状态码"""
+    writer.write(REQUEST)
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+async def wait_ready(uds, timeout: float = 30):
+    """等待 /health 返回 200 (预热完成)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            reader, writer = await open_connection(uds)
+            status = await fetch_health(reader, writer)
+            writer.close()
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("服务器启动超时")
+
+async def run_load(uds, total: int, concurrency: int) -> dict:
+    # 使用裸 asyncio 连接而非 httpx，避免压测客户端自身成为瓶颈
+    latencies = []
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        reader, writer = await open_connection(uds)
+        try:
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                status = await fetch_health(reader, writer)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError(f"/health 返回 {status}")
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="server profile 基准测试")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--profiles", default="default,fast,fast-uds")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for profile in args.profiles.split(","):
+            proc, uds = start_server(profile, workdir)
+            try:
+                asyncio.run(wait_ready(uds))
+                # 预热连接和解释器
+                asyncio.run(run_load(uds, min(1000, args.requests), args.concurrency))
+                results[profile] = asyncio.run(run_load(uds, args.requests, args.concurrency))
+            finally:
+                proc.terminate()
+                proc.wait()
+
+    print(f"\n{'profile':<12}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print("-" * 42)
+    for profile, r in results.items():
+        print(f"{profile:<12}{r['rps']:>10.0f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    print()
+
+if __name__ == "__main__":
+    main()
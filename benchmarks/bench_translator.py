@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+===============================================================================
+                Antigravity API Server - 格式转换基准测试
+===============================================================================
+
+功能：对 map_model / clean_json_schema / transform_tools / claude_to_gemini /
+      gemini_to_claude 做微基准测试，并与保存的基线对比
+
+  - 输入由 transcripts.py 按场景生成 (历史长度、工具数量与 schema 深度、
+    图片、tool_use/tool_result 密度)，固定 seed，结果可复现
+  - 每个用例输出 ops/sec (多轮取最快) 和单次调用的内存分配峰值 (tracemalloc)
+  - 吞吐低于基线超过容差 (默认 25%) 或内存分配高于基线超过容差时退出码为 1
+
+使用方法：
+  python benchmarks/bench_translator.py                   # 与基线对比
+  python benchmarks/bench_translator.py --save-baseline   # 更新基线
+  python benchmarks/bench_translator.py --filter claude_to_gemini --tolerance 0.1
+
+注意：基线与机器相关，更换机器后请先在旧代码上执行 --save-baseline。
+
+===============================================================================
+"""
+import argparse
+import copy
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main as server  # noqa: E402
+from transcripts import SCENARIOS, make_gemini_response, make_transcript  # noqa: E402
+
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+MODEL_NAMES = [
+    "claude-sonnet-4-5-20250929", "claude-opus-4-5", "claude-3-5-haiku-20241022",
+    "gemini-2.5-flash", "gemini-3-pro-preview", "gpt-4o", "some-unknown-model",
+]
+
+def build_cases() -> dict:
+    """返回 {用例名: (函数, 输入, 是否会修改输入)}"""
+    cases = {"map_model": (lambda names: [server.map_model(n) for n in names], MODEL_NAMES, False)}
+
+    for name, params in SCENARIOS.items():
+        request = make_transcript(seed=1, **params)
+        cases[f"claude_to_gemini[{name}]"] = (
+            lambda req: server.claude_to_gemini(req, "bench-project"), request, True
+        )
+    for name in ("short", "many_tools", "deep_schema"):
+        tools = make_transcript(seed=1, **SCENARIOS[name])["tools"]
+        cases[f"transform_tools[{name}]"] = (server.transform_tools, tools, True)
+        cases[f"clean_json_schema[{name}]"] = (
+            lambda ts: [server.clean_json_schema(t["input_schema"]) for t in ts], tools, True
+        )
+
+    cases["gemini_to_claude[small]"] = (
+        lambda resp: server.gemini_to_claude(resp, "gemini-2.5-pro"),
+        make_gemini_response(seed=1, text_parts=1, function_calls=0, words_per_part=50), False
+    )
+    cases["gemini_to_claude[large]"] = (
+        lambda resp: server.gemini_to_claude(resp, "gemini-2.5-pro"),
+        make_gemini_response(seed=1, text_parts=20, function_calls=8, words_per_part=400), False
+    )
+    return cases
+
+def measure(fn, data, mutates: bool, min_time: float, rounds: int) -> dict:
+    """测量 ops/sec (多轮取最快一轮) 和单次调用的内存分配峰值"""
+    # 会修改输入的函数每次调用都用一份新拷贝，拷贝开销不计入计时
+    def inputs(n):
+        return [copy.deepcopy(data) for _ in range(n)] if mutates else [data] * n
+
+    # 校准：估算单次耗时，决定每轮迭代次数
+    sample = inputs(3)
+    start = time.perf_counter()
+    for item in sample:
+        fn(item)
+    per_call = (time.perf_counter() - start) / 3
+    iterations = max(3, min(20000, int(min_time / max(per_call, 1e-7))))
+
+    # 与 timeit 一致：计时期间关闭 GC，取最快一轮以降低机器噪声
+    best = float("inf")
+    for _ in range(rounds):
+        batch = inputs(iterations)
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for item in batch:
+                fn(item)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+        del batch
+
+    item = inputs(1)[0]
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    fn(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ops_per_sec": round(iterations / best, 1), "alloc_kb": round((peak - base) / 1024, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="格式转换基准测试")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果写入基线文件")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的退化比例 (默认 0.25)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮的最短计时秒数")
+    parser.add_argument("--rounds", type=int, default=5, help="计时轮数 (取最快一轮)")
+    parser.add_argument("--filter", default="", help="只运行名称包含该字符串的用例")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"\n{'case':<36}{'ops/sec':>12}{'alloc KB':>11}{'baseline':>12}{'change':>9}")
+    print("-" * 80)
+    for name, (fn, data, mutates) in build_cases().items():
+        if args.filter not in name:
+            continue
+        # 转换函数会打印日志，计时期间丢弃输出 (写出开销仍计入)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = measure(fn, data, mutates, args.min_time, args.rounds)
+        results[name] = result
+
+        base = baseline.get(name)
+        if base:
+            change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+            flag = ""
+            if change < -args.tolerance:
+                flag = " ✗"
+                regressions.append(f"{name}: ops/sec {base['ops_per_sec']} -> {result['ops_per_sec']} ({change:+.0%})")
+            if result["alloc_kb"] > base["alloc_kb"] * (1 + args.tolerance) + 1:
+                flag = " ✗"
+                regressions.append(f"{name}: alloc {base['alloc_kb']}KB -> {result['alloc_kb']}KB")
+            print(f"{name:<36}{result['ops_per_sec']:>12.1f}{result['alloc_kb']:>11.1f}{base['ops_per_sec']:>12.1f}{change:>+9.0%}{flag}")
+        else:
+            print(f"{name:<36}{result['ops_per_sec']:>12.1f}{result['alloc_kb']:>11.1f}{'-':>12}{'-':>9}")
+    print()
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"[✓] 基线已保存: {BASELINE_FILE}\n")
+        return
+
+    if regressions:
+        print(f"[✗] 性能退化超过 {args.tolerance:.0%}:")
+        for line in regressions:
+            print(f"    {line}")
+        print()
+        sys.exit(1)
+    print("[✓] 未发现性能退化\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+===============================================================================
+                Antigravity API Server - 流量回放
+===============================================================================
+
+功能：把 capture 模式录制的 JSONL 按原始到达间隔 (或加速) 重放到本地代理，
+      上游由录制的响应提供，用于离线复现线上负载形态
+
+  - 代理在子进程中启动 (main.app)，上游 HTTP 客户端替换为回放 transport：
+      OAuth / loadCodeAssist  返回固定的假值
+      generateContent         按录制的 ttfb 延迟后返回录制的响应体
+      streamGenerateContent   按录制的时间偏移逐行返回 SSE
+  - 请求通过 X-Replay-Id 头与录制记录对应，并发请求互不干扰
+  - 输出端到端延迟、首字节时间 (TTFB) 分位数与状态码分布
+
+使用方法：
+  python benchmarks/replay.py captures.jsonl
+  python benchmarks/replay.py captures.jsonl --speed 10 --limit 500
+
+注意：录制时被脱敏的字段已替换为等长的 "x"，回放只复现载荷大小与时序，不复现内容。
+
+===============================================================================
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 18766
+
+REPLAY_ID_HEADER = "x-replay-id"
+
+def load_captures(path: str, limit: int) -> list:
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+# ============ 代理子进程 ============
+
+def run_proxy(config_path: str, records: list, speed: float):
+    """子进程入口：加载 main 并把上游替换为录制的响应"""
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ["ANTIGRAVITY_CONFIG"] = config_path
+
+    import httpx
+    import uvicorn
+    import main as server
+
+    by_id = {r["id"]: r for r in records}
+    current_id = contextvars.ContextVar("replay_id", default=None)
+
+    class ReplayIdMiddleware:
+        """把请求头中的回放 ID 放入 contextvar，供回放 transport 查找录制记录"""
+
+        def __init__(self, app):
+            self.app = app
+
+        async def __call__(self, scope, receive, send):
+            if scope["type"] == "http":
+                for name, value in scope["headers"]:
+                    if name == REPLAY_ID_HEADER.encode():
+                        current_id.set(value.decode())
+            await self.app(scope, receive, send)
+
+    class RecordedStream(httpx.AsyncByteStream):
+        def __init__(self, chunks: list):
+            self.chunks = chunks
+
+        async def __aiter__(self):
+            elapsed = 0.0
+            for offset_ms, line in self.chunks:
+                delay = (offset_ms - elapsed) / 1000 / speed
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elapsed = offset_ms
+                yield (line + "\n\n").encode()
+
+    class ReplayTransport(httpx.AsyncBaseTransport):
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            url = str(request.url)
+            if url.startswith(server.TOKEN_URL):
+                return httpx.Response(200, json={"access_token": "replay", "expires_in": 3600})
+            if url.endswith(":loadCodeAssist"):
+                return httpx.Response(200, json={"cloudaicompanionProject": "replay-project"})
+
+            record = by_id.get(current_id.get())
+            if record is None or "upstream" not in record:
+                return httpx.Response(404, text="no recorded response")
+            upstream = record["upstream"]
+            await asyncio.sleep(record.get("timings", {}).get("ttfb", 0) / 1000 / speed)
+
+            if "chunks" in upstream:
+                status = upstream["status"] or 502
+                if status != 200:
+                    text = upstream["chunks"][0][1] if upstream["chunks"] else ""
+                    return httpx.Response(status, text=text)
+                return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                      stream=RecordedStream(upstream["chunks"]))
+            if "body" in upstream:
+                return httpx.Response(upstream["status"], json=upstream["body"])
+            return httpx.Response(upstream["status"], text=upstream.get("text", ""))
+
+    server.create_http_client = lambda: httpx.AsyncClient(transport=ReplayTransport())
+    server.app.add_middleware(ReplayIdMiddleware)
+    uvicorn.run(server.app, host="127.0.0.1", port=PORT, log_level="warning")
+
+# ============ 回放客户端 ============
+
+async def wait_ready(client, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("代理启动超时")
+
+async def replay_one(client, record: dict) -> dict:
+    start = time.perf_counter()
+    ttfb = None
+    async with client.stream("POST", "/v1/messages", json=record["request"],
+                             headers={REPLAY_ID_HEADER: record["id"]}) as resp:
+        async for _ in resp.aiter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return {"status": resp.status_code, "ttfb": ttfb if ttfb is not None else total, "total": total}
+
+async def replay(records: list, speed: float, concurrency: int) -> list:
+    import httpx
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=600, limits=limits) as client:
+        await wait_ready(client)
+        origin = records[0]["ts"]
+        start = time.perf_counter()
+
+        async def scheduled(record):
+            # 按原始到达间隔 (除以 speed) 发出请求
+            delay = (record["ts"] - origin) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await replay_one(client, record)
+            except Exception as e:
+                return {"status": type(e).__name__, "ttfb": None, "total": None}
+
+        results = await asyncio.gather(*[scheduled(r) for r in records])
+        elapsed = time.perf_counter() - start
+    print(f"\n回放 {len(records)} 个请求，用时 {elapsed:.2f}s (录制时长 {(records[-1]['ts'] - origin):.2f}s，speed {speed}x)")
+    return results
+
+def percentiles(values: list) -> str:
+    values = sorted(v * 1000 for v in values if v is not None)
+    if not values:
+        return "-"
+    p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+    return f"p50 {statistics.median(values):.1f}ms  p99 {p99:.1f}ms  max {values[-1]:.1f}ms"
+
+def main():
+    parser = argparse.ArgumentParser(description="按录制的流量回放")
+    parser.add_argument("capture", help="capture 模式生成的 JSONL 文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="加速倍数 (到达间隔与上游延迟同时缩放)")
+    parser.add_argument("--limit", type=int, default=0, help="只回放前 N 条记录")
+    parser.add_argument("--concurrency", type=int, default=100, help="客户端最大连接数")
+    args = parser.parse_args()
+
+    records = load_captures(args.capture, args.limit)
+    if not records:
+        sys.exit("录制文件为空")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(ROOT, "config.json")) as f:
+            config = json.load(f)
+        config["state_db"] = os.path.join(workdir, "state.db")
+        config["capture"] = {"enabled": False}
+        config_path = os.path.join(workdir, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+
+        proc = multiprocessing.get_context("spawn").Process(
+            target=run_proxy, args=(config_path, records, args.speed), daemon=True
+        )
+        proc.start()
+        try:
+            results = asyncio.run(replay(records, args.speed, args.concurrency))
+        finally:
+            proc.terminate()
+            proc.join()
+
+    statuses = {}
+    for r in results:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+    print(f"状态码: {', '.join(f'{k}={v}' for k, v in statuses.items())}")
+    print(f"TTFB:   {percentiles([r['ttfb'] for r in results])}")
+    print(f"总耗时: {percentiles([r['total'] for r in results])}\n")
+
+if __name__ == "__main__":
+    main()
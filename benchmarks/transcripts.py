@@ -0,0 +1,141 @@
+"""
+合成 Claude Code 会话生成器 (供基准测试使用)
+
+按参数生成结构上接近真实 Claude Code 流量的请求/响应：
+  - 长 system prompt (多个 text 块)
+  - 带 $defs/$ref、anyOf、校验字段的多层工具 schema
+  - 交替的 text / tool_use / tool_result，密度可调
+  - base64 图片块
+相同 seed 生成的数据完全一致，便于与基线对比。
+"""
+import base64
+import random
+from typing import Any, Dict, List
+
+WORDS = (
+    "def return self import async await json request response model token "
+    "stream content parts text tool result error config path file line value "
+    "the a to of and in is for that with on this it should must when if then"
+).split()
+
+TOOL_NAMES = [
+    "Read", "Write", "Edit", "MultiEdit", "Bash", "Glob", "Grep", "LS",
+    "WebFetch", "WebSearch", "TodoWrite", "NotebookEdit", "Task", "ExitPlanMode",
+]
+
+# 调参后的典型场景
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "short": {"turns": 4, "tools": 8, "schema_depth": 2},
+    "long_history": {"turns": 120, "tools": 16, "schema_depth": 3},
+    "many_tools": {"turns": 10, "tools": 60, "schema_depth": 3},
+    "deep_schema": {"turns": 10, "tools": 8, "schema_depth": 5},
+    "images": {"turns": 20, "tools": 16, "image_every": 3},
+    "tool_dense": {"turns": 60, "tools": 16, "tool_density": 1.0},
+    "claude_model": {"turns": 60, "tools": 16, "model": "claude-sonnet-4-5"},
+}
+
+def text(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+def make_schema(rng: random.Random, depth: int, width: int = 3) -> Dict[str, Any]:
+    """生成一个 depth 层嵌套的工具 input_schema，包含 Gemini 不支持、需要清理的字段"""
+    def node(level: int) -> Dict[str, Any]:
+        if level >= depth:
+            kind = rng.choice(["string", "integer", "boolean", "enum", "nullable"])
+            if kind == "string":
+                return {"type": "string", "description": text(rng, 8), "minLength": 1, "pattern": "^[a-z]+$"}
+            if kind == "integer":
+                return {"type": "integer", "minimum": 0, "maximum": 1000, "default": 10}
+            if kind == "enum":
+                return {"type": "string", "enum": ["a", "b", "c"], "description": text(rng, 4)}
+            if kind == "nullable":
+                return {"type": ["string", "null"], "format": "uri"}
+            return {"type": "boolean"}
+        props = {f"field_{level}_{i}": node(level + 1) for i in range(width)}
+        props[f"ref_{level}"] = {"$ref": "#/$defs/Shared"}
+        props[f"union_{level}"] = {"anyOf": [{"type": "string"}, {"type": "number"}]}
+        return {
+            "type": "object",
+            "properties": props,
+            "required": list(props)[:2] + ["missing"],
+            "additionalProperties": False,
+        }
+
+    schema = node(0)
+    schema["$schema"] = "http://json-schema.org/draft-07/schema#"
+    schema["$defs"] = {"Shared": {"type": "object", "properties": {"id": {"type": "string", "maxLength": 64}}}}
+    return schema
+
+def make_tools(rng: random.Random, count: int, schema_depth: int) -> List[Dict[str, Any]]:
+    tools = []
+    for i in range(count):
+        name = TOOL_NAMES[i % len(TOOL_NAMES)] + (f"_{i}" if i >= len(TOOL_NAMES) else "")
+        tools.append({"name": name, "description": text(rng, 40), "input_schema": make_schema(rng, schema_depth)})
+    return tools
+
+def random_bytes(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+def make_image(rng: random.Random, size: int = 16384) -> Dict[str, Any]:
+    data = base64.b64encode(random_bytes(rng, size)).decode()
+    return {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}}
+
+def make_transcript(seed: int = 0, turns: int = 20, tools: int = 16, schema_depth: int = 3,
+                    image_every: int = 0, tool_density: float = 0.7,
+                    model: str = "gemini-2.5-pro") -> Dict[str, Any]:
+    """生成一个 Claude Messages API 请求
+
+    turns:        助手轮数 (每轮一条 assistant + 一条 user)
+    tools:        工具定义数量
+    schema_depth: 工具 schema 嵌套深度
+    image_every:  每隔多少条 user 消息附带一张图片 (0 表示不带)
+    tool_density: 助手轮调用工具的概率
+    """
+    rng = random.Random(seed)
+    tool_defs = make_tools(rng, tools, schema_depth)
+
+    messages = [{"role": "user", "content": text(rng, 80)}]
+    user_count = 1
+    for i in range(turns):
+        if rng.random() < tool_density:
+            tool = rng.choice(tool_defs)
+            messages.append({"role": "assistant", "content": [
+                {"type": "text", "text": text(rng, 30)},
+                {"type": "tool_use", "id": f"toolu_{seed}_{i}", "name": tool["name"],
+                 "input": {"file_path": f"/repo/src/module_{i}.py", "limit": 200}},
+            ]})
+            user_content = [{"type": "tool_result", "tool_use_id": f"toolu_{seed}_{i}",
+                             "content": text(rng, rng.randint(50, 800))}]
+        else:
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": text(rng, 120)}]})
+            user_content = [{"type": "text", "text": text(rng, 40)}]
+
+        user_count += 1
+        if image_every and user_count % image_every == 0:
+            user_content.append(make_image(rng))
+        messages.append({"role": "user", "content": user_content})
+
+    return {
+        "model": model,
+        "max_tokens": 8192,
+        "temperature": 1.0,
+        "stream": False,
+        "system": [{"type": "text", "text": text(rng, 1500)}, {"type": "text", "text": text(rng, 300)}],
+        "tools": tool_defs,
+        "messages": messages,
+    }
+
+def make_gemini_response(seed: int = 0, text_parts: int = 3, function_calls: int = 1,
+                         words_per_part: int = 200) -> Dict[str, Any]:
+    """生成一个 Cloud Code generateContent 响应"""
+    rng = random.Random(seed)
+    parts: List[Dict[str, Any]] = [{"text": text(rng, words_per_part)} for _ in range(text_parts)]
+    for i in range(function_calls):
+        parts.append({
+            "functionCall": {"name": rng.choice(TOOL_NAMES), "args": {"file_path": f"/repo/f{i}.py", "content": text(rng, 80)}},
+            "thoughtSignature": base64.b64encode(random_bytes(rng, 96)).decode(),
+        })
+    return {"response": {
+        "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+        "usageMetadata": {"promptTokenCount": 48000, "candidatesTokenCount": 1800},
+    }}
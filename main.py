@@ -4,16 +4,41 @@ Antigravity API Server
 使用 Google Cloud Code API (cloudcode-pa.googleapis.com)
 """
 import json
+import os
+import random
+import re
 import time
+import gzip
+import zlib
+import fcntl
+import hmac
+import hashlib
+import importlib.util
+import signal
+import socket
+import sys
+import sqlite3
 import httpx
 import uuid
+from collections import Counter, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from starlette.background import BackgroundTask
+from starlette.datastructures import MutableHeaders
+from typing import Optional, List, Dict, Any, Tuple
 import asyncio
 
-app = FastAPI(title="Antigravity API Server")
+# 可选依赖：安装后可协商 br / zstd 压缩
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # ============ 全局状态 ============
 import threading
@@ -22,17 +47,26 @@ THOUGHT_SIGNATURE_LOCK = threading.Lock()
 
 def store_thought_signature(sig: str):
     global THOUGHT_SIGNATURE
-    if sig:
-        with THOUGHT_SIGNATURE_LOCK:
-            THOUGHT_SIGNATURE = sig
-            # print(f"[DEBUG] Stored thought_signature: {sig[:20]}...")
+    if not sig:
+        return
+    # 多 worker 时直接写共享状态，下一轮请求可能落在其它 worker 上；
+    # 不能与本 worker 的旧值比较去重，共享状态可能已被其它 worker 覆盖
+    if WORKERS > 1:
+        STATE.set("thought_signature", sig)
+        return
+    with THOUGHT_SIGNATURE_LOCK:
+        THOUGHT_SIGNATURE = sig
+        # print(f"[DEBUG] Stored thought_signature: {sig[:20]}...")
 
 def get_thought_signature() -> Optional[str]:
+    if WORKERS > 1:
+        return STATE.get("thought_signature")
     with THOUGHT_SIGNATURE_LOCK:
         return THOUGHT_SIGNATURE
 
 # ============ 配置 ============
-with open("config.json") as f:
+# 环境变量 ANTIGRAVITY_CONFIG 可指定其它配置文件 (基准测试等场景)
+with open(os.environ.get("ANTIGRAVITY_CONFIG", "config.json")) as f:
     CONFIG = json.load(f)
 
 REFRESH_TOKEN = CONFIG["refresh_token"]
@@ -42,30 +76,412 @@ TOKEN_URL = "https://oauth2.googleapis.com/token"
 CLIENT_ID = "1071006060591-tmhssin2h21lcre235vtolojh4g403ep.apps.googleusercontent.com"
 CLIENT_SECRET = "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"
 
-# Cloud Code API 端点
+# Cloud Code API 端点：endpoints 为按优先级排列的列表，前一个不可用时切换到下一个
 CLOUDCODE_API = "https://cloudcode-pa.googleapis.com/v1internal"
+CLOUDCODE_ENDPOINTS = CONFIG.get("endpoints") or [CLOUDCODE_API]
 USER_AGENT = "antigravity/1.11.9 linux/amd64"
 
+# 共享状态库 (SQLite)：凭据缓存、thought_signature 等，重启后复用、多 worker 间共享
+STATE_DB_FILE = CONFIG.get("state_db", ".antigravity_state.db")
+
+# uvicorn worker 进程数 (环境变量 ANTIGRAVITY_WORKERS 优先)
+WORKERS = max(1, int(os.environ.get("ANTIGRAVITY_WORKERS", CONFIG.get("workers", 1))))
+
 # 缓存
 _access_token = None
 _token_expires_at = 0
 _project_id = None
 
+# 共享的上游 HTTP 客户端 (连接池)，由 lifespan 创建
+_http_client: Optional[httpx.AsyncClient] = None
+
+# 上下文压缩 (默认关闭)：历史超出 token 预算时，在转换前裁剪旧的 tool_result / 图片 / 早期轮次
+COMPACTION = {
+    "enabled": False,
+    "token_budget": 200000,
+    "keep_recent_messages": 10,
+    "tool_result_max_chars": 2000,
+    "summary_max_chars": 4000,
+    **CONFIG.get("compaction", {}),
+}
+
+# 压缩：下游响应按 Accept-Encoding 协商；SSE 和上游请求体默认不压缩
+COMPRESSION = {
+    "enabled": True,
+    "min_size": 1024,
+    "sse": False,
+    "upstream": False,
+    "upstream_min_size": 32768,
+    **CONFIG.get("compression", {}),
+}
+
+# 流量录制 (默认关闭)：抽样记录 /v1/messages 请求与上游响应，供 benchmarks/replay.py 回放
+CAPTURE = {
+    "enabled": False,
+    "path": "captures.jsonl",
+    "sample_rate": 1.0,
+    # 命中这些字段的字符串替换为等长的 "x" (保留载荷大小)，空列表表示不脱敏
+    "redact": ["system", "text", "content", "data", "input", "args", "thoughtSignature"],
+    "queue_size": 1000,
+    **CONFIG.get("capture", {}),
+}
+
+# 用量统计：按客户端 (API Key) 和模型累计请求数与 token，内存中累加、定期批量写入 state_db
+USAGE = {
+    "enabled": True,
+    "flush_interval": 30,
+    # API Key -> 显示名称；未列出的 Key 以哈希前缀标识
+    "clients": {},
+    **CONFIG.get("usage", {}),
+}
+
+# 非流式请求也以 streamGenerateContent 访问上游并在本地聚合 (默认关闭)：
+# 上游空闲超过 idle_timeout 秒即中断，未向客户端发送任何数据前的失败可换端点重试 retries 次
+STREAM_AGGREGATE = {
+    "enabled": False,
+    "idle_timeout": 120,
+    "retries": 1,
+    **CONFIG.get("stream_aggregate", {}),
+}
+
+# 端点故障切换：后台探测 + 按请求结果被动摘除 (连续失败 eject_after 次后摘除，时长逐次翻倍)
+FAILOVER = {
+    "probe_interval": 30,
+    "probe_timeout": 5,
+    "eject_after": 3,
+    "eject_seconds": 30,
+    "max_eject_seconds": 300,
+    **CONFIG.get("failover", {}),
+}
+
+# 管理端点 (/debug/*) 密钥；未配置时仅允许本机访问
+ADMIN_KEY = CONFIG.get("admin_key")
+
+# 平滑退出：收到 SIGTERM 或 POST /debug/drain 后不再接收新请求，
+# 等待进行中的流式响应结束，超过 timeout 秒仍未结束的会被中断
+DRAIN = {"timeout": 300, **CONFIG.get("drain", {})}
+
+# 启动预热状态
+_ready = False
+_warmup_error: Optional[str] = None
+
+# 平滑退出状态
+_draining = False
+_active_streams = 0
+
+# ============ 共享状态 ============
+class SharedState:
+    """基于 SQLite (WAL) 的跨进程键值存储，配合文件锁协调多个 worker"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 库中保存 Access Token，先以 0600 创建
+            if not os.path.exists(self.path):
+                os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o600))
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.chmod(self.path + suffix, 0o600)
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            row = self._conn().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[State] 读取 {key} 失败: {e}")
+            return default
+        return json.loads(row[0]) if row else default
+    
+    def set(self, key: str, value: Any):
+        try:
+            self._conn().execute(
+                "INSERT INTO kv (key, value, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (key, json.dumps(value), time.time())
+            )
+        except sqlite3.Error as e:
+            print(f"[State] 写入 {key} 失败: {e}")
+    
+    def acquire_lock(self, name: str) -> int:
+        """获取跨进程排他锁 (阻塞)，返回需传给 release_lock 的 fd"""
+        fd = os.open(f"{self.path}.{name}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+    
+    def release_lock(self, fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    
+    def execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        return self._conn().execute(sql, params).fetchall()
+    
+    def executemany(self, sql: str, rows: List[tuple]):
+        """在一个事务中批量执行"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+STATE = SharedState(STATE_DB_FILE)
+_local_locks: Dict[str, asyncio.Lock] = {}
+
+@asynccontextmanager
+async def shared_lock(name: str):
+    """进程内 asyncio 锁 + 跨进程文件锁，保证同一时刻只有一个协程执行临界区"""
+    local_lock = _local_locks.setdefault(name, asyncio.Lock())
+    async with local_lock:
+        fd = await asyncio.to_thread(STATE.acquire_lock, name)
+        try:
+            yield
+        finally:
+            STATE.release_lock(fd)
+
+# ============ 凭据缓存 ============
+def _refresh_token_fingerprint() -> str:
+    """refresh_token 指纹，用于识别缓存是否属于当前账号"""
+    return hashlib.sha256(REFRESH_TOKEN.encode()).hexdigest()[:16]
+
+def load_token_cache():
+    """从共享状态恢复 Access Token 和 Project ID (可能由其它 worker 写入)"""
+    global _access_token, _token_expires_at, _project_id
+    
+    cache = STATE.get("credentials")
+    if not cache:
+        return
+    
+    # refresh_token 已更换 (例如重新运行了 get_token.py)，旧缓存作废
+    if cache.get("refresh_token_hash") != _refresh_token_fingerprint():
+        return
+    
+    _access_token = cache.get("access_token")
+    _token_expires_at = cache.get("expires_at", 0)
+    _project_id = cache.get("project_id")
+
+def save_token_cache():
+    """将凭据写入共享状态"""
+    STATE.set("credentials", {
+        "refresh_token_hash": _refresh_token_fingerprint(),
+        "access_token": _access_token,
+        "expires_at": _token_expires_at,
+        "project_id": _project_id,
+    })
+
+# ============ 上游连接 ============
+def create_http_client() -> httpx.AsyncClient:
+    """创建上游 HTTP 客户端 (长连接复用)"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(600, connect=30),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120),
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的上游客户端 (未经 lifespan 启动时惰性创建)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+# ============ 上游端点 ============
+# 这些状态码说明端点本身有问题 (或被限流)，换一个端点重试
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class Endpoint:
+    """单个 Cloud Code 端点的健康状态与指标 (每个 worker 各自统计)"""
+    
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.requests = 0
+        self.errors: Counter = Counter()
+        self.failovers = 0
+        self.latencies: deque = deque(maxlen=512)
+        self.consecutive_failures = 0
+        self.probe_failures = 0  # consecutive_failures 中由探测造成的部分
+        self.ejected_until = 0.0
+        self.ejected_by_probe = False
+        self.ejections = 0
+        self.last_error: Optional[str] = None
+        self.last_probe: Optional[dict] = None
+    
+    def healthy(self) -> bool:
+        return time.time() >= self.ejected_until
+    
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latencies.append(latency * 1000)
+        self.consecutive_failures = 0
+        self.probe_failures = 0
+    
+    def record_failure(self, error: str, request: bool = True, probe: bool = False):
+        if request:
+            self.requests += 1
+            self.errors[error.split(":")[0]] += 1
+        self.last_error = error
+        self.consecutive_failures += 1
+        if probe:
+            self.probe_failures += 1
+        if self.consecutive_failures >= FAILOVER["eject_after"] and self.healthy():
+            duration = min(FAILOVER["eject_seconds"] * 2 ** self.ejections, FAILOVER["max_eject_seconds"])
+            self.ejected_until = time.time() + duration
+            self.ejected_by_probe = probe
+            self.ejections += 1
+            print(f"[Endpoint] {self.base_url} 连续失败 {self.consecutive_failures} 次，摘除 {duration}s ({error})")
+    
+    def record_probe_success(self):
+        """探测成功只撤销探测造成的失败计数与摘除
+        
+        探测只验证端点可达，不能说明 API 本身已恢复：因请求失败 (5xx/429/断流) 被摘除的端点
+        仍要等摘除时间到期，再由真实请求验证。
+        """
+        self.consecutive_failures -= self.probe_failures
+        self.probe_failures = 0
+        if not self.healthy() and self.ejected_by_probe:
+            print(f"[Endpoint] {self.base_url} 探测恢复，重新启用")
+            self.ejected_until = 0.0
+    
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1) if latencies else None
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy(),
+            "ejected_for": max(0, round(self.ejected_until - time.time(), 1)),
+            "ejected_by": ("probe" if self.ejected_by_probe else "requests") if not self.healthy() else None,
+            "ejections": self.ejections,
+            "requests": self.requests,
+            "errors": dict(self.errors),
+            "failovers": self.failovers,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": {"p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99)},
+            "last_error": self.last_error,
+            "last_probe": self.last_probe,
+        }
+
+ENDPOINTS = [Endpoint(url) for url in CLOUDCODE_ENDPOINTS]
+
+def endpoint_candidates() -> List[Endpoint]:
+    """按配置顺序返回健康端点；被摘除的端点按恢复时间排在最后，保证总有端点可用"""
+    healthy = [e for e in ENDPOINTS if e.healthy()]
+    ejected = sorted((e for e in ENDPOINTS if not e.healthy()), key=lambda e: e.ejected_until)
+    return healthy + ejected
+
+@asynccontextmanager
+async def upstream_request(method: str, content: bytes, headers: Dict[str, str], query: str = "",
+                           timeout: Any = httpx.USE_CLIENT_DEFAULT, attempted: Optional[List[Endpoint]] = None):
+    """向 Cloud Code 发送请求，传输错误 / 5xx / 429 时按顺序切换端点
+    
+    只在收到响应头之前切换，下游尚未收到任何数据；yield 的响应为流式，退出时关闭。
+    最后一个端点的错误响应原样返回，由调用方处理。
+    attempted: 调用方整体重试时传入，优先选择不在其中的端点，选中的端点会追加进去。
+    """
+    client = get_http_client()
+    candidates = endpoint_candidates()
+    if attempted:
+        candidates = [e for e in candidates if e not in attempted] or candidates
+    resp = endpoint = None
+    for i, candidate in enumerate(candidates):
+        is_last = i == len(candidates) - 1
+        url = f"{candidate.base_url}:{method}" + (f"?{query}" if query else "")
+        start = time.perf_counter()
+        try:
+            resp = await client.send(
+                client.build_request("POST", url, content=content, headers=headers, timeout=timeout), stream=True
+            )
+        except httpx.TransportError as e:
+            candidate.record_failure(f"{type(e).__name__}: {e}")
+            if is_last:
+                raise
+            candidate.failovers += 1
+            print(f"[Endpoint] {candidate.base_url} {type(e).__name__}，切换到下一个端点")
+            continue
+        
+        if resp.status_code in RETRYABLE_STATUS:
+            candidate.record_failure(f"HTTP {resp.status_code}")
+            if not is_last:
+                await resp.aclose()
+                candidate.failovers += 1
+                print(f"[Endpoint] {candidate.base_url} 返回 {resp.status_code}，切换到下一个端点")
+                continue
+        else:
+            candidate.record_success(time.perf_counter() - start)
+        endpoint = candidate
+        break
+    if attempted is not None:
+        attempted.append(endpoint)
+    
+    try:
+        yield resp
+    except httpx.TransportError as e:
+        # 流式读取中途断开：计入被动检测，但数据已发往下游，不再切换
+        endpoint.record_failure(f"{type(e).__name__}: {e}", request=False)
+        raise
+    finally:
+        await resp.aclose()
+
+async def probe_endpoint(endpoint: Endpoint):
+    """主动探测：请求端点根路径 (无需鉴权)，能收到非 5xx 响应即视为可达"""
+    origin = httpx.URL(endpoint.base_url).copy_with(path="/", query=None)
+    start = time.perf_counter()
+    try:
+        resp = await get_http_client().get(origin, headers={"User-Agent": USER_AGENT}, timeout=FAILOVER["probe_timeout"])
+        ok = resp.status_code < 500
+        endpoint.last_probe = {"ok": ok, "status": resp.status_code,
+                               "latency_ms": round((time.perf_counter() - start) * 1000, 1), "at": time.time()}
+        error = f"probe HTTP {resp.status_code}"
+    except httpx.HTTPError as e:
+        ok = False
+        endpoint.last_probe = {"ok": False, "error": f"{type(e).__name__}: {e}", "at": time.time()}
+        error = f"probe {type(e).__name__}"
+    if ok:
+        endpoint.record_probe_success()
+    else:
+        endpoint.record_failure(error, request=False, probe=True)
+
+async def probe_loop():
+    """后台定期探测全部端点"""
+    while True:
+        await asyncio.sleep(FAILOVER["probe_interval"])
+        await asyncio.gather(*(probe_endpoint(e) for e in ENDPOINTS))
+
 # ============ Token 管理 ============
+def _token_valid() -> bool:
+    return bool(_access_token) and time.time() < _token_expires_at - 300
+
 async def get_access_token() -> str:
     """获取有效的 Access Token，自动刷新"""
     global _access_token, _token_expires_at
     
-    if _access_token and time.time() < _token_expires_at - 300:
+    if _token_valid():
         return _access_token
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(TOKEN_URL, data={
+    # 加锁后再检查一次：其它 worker/协程可能刚刚完成刷新
+    async with shared_lock("token"):
+        load_token_cache()
+        if _token_valid():
+            return _access_token
+        
+        resp = await get_http_client().post(TOKEN_URL, data={
             "client_id": CLIENT_ID,
             "client_secret": CLIENT_SECRET,
             "refresh_token": REFRESH_TOKEN,
             "grant_type": "refresh_token"
-        })
+        }, timeout=30)
         
         if resp.status_code != 200:
             raise HTTPException(500, f"Token 刷新失败: {resp.text}")
@@ -74,9 +490,20 @@ async def get_access_token() -> str:
         _access_token = data["access_token"]
         _token_expires_at = time.time() + data.get("expires_in", 3600)
         print(f"[Token] 已刷新，有效期至 {time.ctime(_token_expires_at)}")
+        save_token_cache()
         
     return _access_token
 
+def invalidate_access_token():
+    """上游返回 401 时丢弃当前 Token，下次请求强制刷新"""
+    global _token_expires_at
+    bad_token = _access_token
+    _token_expires_at = 0
+    # 共享状态中仍是这个 Token 时一并作废 (其它 worker 已刷新则保留新 Token)
+    cache = STATE.get("credentials") or {}
+    if cache.get("access_token") == bad_token:
+        save_token_cache()
+
 async def get_project_id() -> str:
     """获取 Cloud Code Project ID"""
     global _project_id
@@ -86,16 +513,22 @@ async def get_project_id() -> str:
     
     access_token = await get_access_token()
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(
-            f"{CLOUDCODE_API}:loadCodeAssist",
+    async with shared_lock("project"):
+        load_token_cache()
+        if _project_id:
+            return _project_id
+        
+        async with upstream_request(
+            "loadCodeAssist",
+            json.dumps({"metadata": {"ideType": "ANTIGRAVITY"}}).encode(),
             headers={
                 "Authorization": f"Bearer {access_token}",
                 "Content-Type": "application/json",
                 "User-Agent": USER_AGENT
             },
-            json={"metadata": {"ideType": "ANTIGRAVITY"}}
-        )
+            timeout=30
+        ) as resp:
+            await resp.aread()
         
         if resp.status_code != 200:
             raise HTTPException(500, f"获取 Project ID 失败: {resp.text}")
@@ -108,9 +541,73 @@ async def get_project_id() -> str:
             print(f"[Project] 未获取到官方 ID，使用随机: {_project_id}")
         else:
             print(f"[Project] 获取成功: {_project_id}")
+        save_token_cache()
         
     return _project_id
 
+# ============ 启动预热 ============
+async def warmup():
+    """启动预热：恢复缓存、校验/刷新 Token、获取 Project ID、建立上游连接"""
+    global _ready, _warmup_error
+    
+    start = time.time()
+    try:
+        load_token_cache()
+        if _access_token:
+            print(f"[Cache] 已恢复凭据 (Token 有效期至 {time.ctime(_token_expires_at)}, Project: {_project_id})")
+        await get_access_token()
+        await get_project_id()
+        # 首轮探测同时预先完成到各端点的 TCP/TLS 握手，连接留在连接池中供首个请求复用
+        await asyncio.gather(*(probe_endpoint(e) for e in ENDPOINTS))
+        print(f"[Warmup] 预热完成，耗时 {time.time() - start:.2f}s")
+    except Exception as e:
+        # 预热失败不阻止服务启动，后续请求仍会按需获取凭据
+        _warmup_error = str(e) or type(e).__name__
+        print(f"[Warmup] 预热失败: {_warmup_error}")
+    finally:
+        _ready = True
+
+# ============ 平滑退出 ============
+def begin_drain(reason: str):
+    global _draining
+    if not _draining:
+        _draining = True
+        print(f"[Drain] {reason}: 停止接收新请求，等待 {_active_streams} 个流式响应结束 (最多 {DRAIN['timeout']}s)")
+
+def install_drain_handlers():
+    """在 uvicorn 的退出信号处理函数外包一层：先进入 drain 状态，再由 uvicorn 关闭监听并等待在途请求"""
+    # 只有主线程能设置信号处理 (TestClient 等场景下 lifespan 不在主线程)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+        def handler(signum, frame, previous=previous):
+            begin_drain(signal.Signals(signum).name)
+            previous(signum, frame)
+        signal.signal(sig, handler)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _http_client
+    _http_client = create_http_client()
+    install_drain_handlers()
+    warmup_task = asyncio.create_task(warmup())
+    probe_task = asyncio.create_task(probe_loop())
+    capture_task = asyncio.create_task(CAPTURER.run()) if CAPTURE["enabled"] else None
+    usage_task = asyncio.create_task(USAGE_LOG.run()) if USAGE["enabled"] else None
+    try:
+        yield
+    finally:
+        warmup_task.cancel()
+        probe_task.cancel()
+        for task in (capture_task, usage_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await _http_client.aclose()
+
 # ============ 模型映射 ============
 # ============ 模型映射 ============
 def map_model(claude_model: str) -> str:
@@ -194,7 +691,163 @@ def map_model(claude_model: str) -> str:
     print(f"\033[91m[Model Map] Unknown model '{claude_model}'. Fallback -> '{fallback}'\033[0m")
     return fallback
 
-# ============ 格式转换 ============
+# ============ 上下文压缩 ============
+def _json_size(obj: Any) -> int:
+    """序列化后的字节数"""
+    return len(json.dumps(obj, ensure_ascii=False).encode())
+
+def _estimate_tokens(size: int) -> int:
+    """粗略估算 token 数 (约 4 字节/token)"""
+    return size // 4
+
+def _elide_text(text: str, max_chars: int) -> str:
+    """保留首尾，省略中间部分"""
+    if len(text) <= max_chars:
+        return text
+    keep = max_chars // 2
+    return f"{text[:keep]}\n...[已省略 {len(text) - 2 * keep} 字符]...\n{text[-keep:]}"
+
+def _block_text(block: Any) -> str:
+    """提取内容块中的文本 (用于生成摘要)"""
+    if isinstance(block, str):
+        return block
+    if not isinstance(block, dict):
+        return ""
+    if block.get("type") == "text":
+        return block.get("text", "")
+    if block.get("type") == "tool_use":
+        return f"[调用工具 {block.get('name')}]"
+    if block.get("type") == "tool_result":
+        return "[工具结果]"
+    if block.get("type") == "image":
+        return "[图片]"
+    return ""
+
+def _summarize_messages(messages: List[dict], max_chars: int) -> str:
+    """将早期轮次折叠为抽取式摘要 (每条消息保留开头部分)"""
+    per_message = max(80, max_chars // max(len(messages), 1))
+    lines = []
+    for msg in messages:
+        content = msg["content"]
+        blocks = content if isinstance(content, list) else [content]
+        text = " ".join(t for t in (_block_text(b) for b in blocks) if t)
+        text = " ".join(text.split())
+        if text:
+            lines.append(f"{msg['role']}: {text[:per_message]}")
+    summary = "\n".join(lines)
+    return summary[:max_chars]
+
+def _has_tool_result(msg: dict) -> bool:
+    content = msg["content"]
+    return isinstance(content, list) and any(
+        isinstance(b, dict) and b.get("type") == "tool_result" for b in content
+    )
+
+def compact_request(claude_request: dict) -> Optional[dict]:
+    """超出 token 预算时就地压缩 messages，返回统计信息 (未压缩返回 None)
+    
+    依次执行，预算满足即停止：
+      1. 截断旧消息中过长的 tool_result (保留首尾)
+      2. 将旧消息中的图片替换为占位文本
+      3. 把早期轮次折叠成一段摘要，并入第一条保留的用户消息
+    最近 keep_recent_messages 条消息不动；折叠边界只选在不含 tool_result 的用户消息上，
+    保证 tool_use / tool_result 不被拆开。
+    """
+    messages = claude_request.get("messages", [])
+    budget_bytes = COMPACTION["token_budget"] * 4
+    fixed_size = _json_size(claude_request.get("system")) + _json_size(claude_request.get("tools"))
+    sizes = [_json_size(m) for m in messages]
+    before = fixed_size + sum(sizes)
+    if before <= budget_bytes:
+        return None
+    
+    stats = {"tool_results": 0, "images": 0, "collapsed": 0}
+    protected = max(len(messages) - COMPACTION["keep_recent_messages"], 0)
+    max_chars = COMPACTION["tool_result_max_chars"]
+    
+    def total() -> int:
+        return fixed_size + sum(sizes)
+    
+    # 1. 截断旧 tool_result
+    for i in range(protected):
+        if total() <= budget_bytes:
+            break
+        content = messages[i]["content"]
+        if not isinstance(content, list):
+            continue
+        changed = False
+        for block in content:
+            if not (isinstance(block, dict) and block.get("type") == "tool_result"):
+                continue
+            result = block.get("content", "")
+            truncated = False
+            if isinstance(result, str) and len(result) > max_chars:
+                block["content"] = _elide_text(result, max_chars)
+                truncated = True
+            elif isinstance(result, list):
+                for item in result:
+                    if isinstance(item, dict) and item.get("type") == "text" and len(item.get("text", "")) > max_chars:
+                        item["text"] = _elide_text(item["text"], max_chars)
+                        truncated = True
+            if truncated:
+                stats["tool_results"] += 1
+                changed = True
+        if changed:
+            sizes[i] = _json_size(messages[i])
+    
+    # 2. 丢弃旧图片 (包括 tool_result 内嵌的图片)
+    for i in range(protected):
+        if total() <= budget_bytes:
+            break
+        content = messages[i]["content"]
+        if not isinstance(content, list):
+            continue
+        changed = False
+        for container in [content] + [
+            b["content"] for b in content
+            if isinstance(b, dict) and b.get("type") == "tool_result" and isinstance(b.get("content"), list)
+        ]:
+            for j, block in enumerate(container):
+                if isinstance(block, dict) and block.get("type") == "image":
+                    container[j] = {"type": "text", "text": "[图片已省略]"}
+                    stats["images"] += 1
+                    changed = True
+        if changed:
+            sizes[i] = _json_size(messages[i])
+    
+    # 3. 折叠早期轮次：选择满足预算的最早边界，都不满足时取最靠后的边界
+    if total() > budget_bytes:
+        cut = None
+        for i in range(1, protected + 1):
+            if i >= len(messages):
+                break
+            msg = messages[i]
+            if msg["role"] != "user" or _has_tool_result(msg):
+                continue
+            cut = i
+            if fixed_size + sum(sizes[i:]) + COMPACTION["summary_max_chars"] <= budget_bytes:
+                break
+        if cut:
+            summary = _summarize_messages(messages[:cut], COMPACTION["summary_max_chars"])
+            first = messages[cut]
+            content = first["content"]
+            blocks = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+            first["content"] = [
+                {"type": "text", "text": f"[早期对话摘要，共 {cut} 条消息已折叠]\n{summary}"}
+            ] + blocks
+            stats["collapsed"] = cut
+            del messages[:cut]
+            sizes = [_json_size(first)] + sizes[cut + 1:]
+    
+    after = total()
+    stats["saved_bytes"] = before - after
+    stats["saved_tokens"] = _estimate_tokens(before) - _estimate_tokens(after)
+    print(
+        f"[Compaction] {before} -> {after} bytes (约节省 {stats['saved_tokens']} tokens): "
+        f"tool_result 截断 {stats['tool_results']}, 图片 {stats['images']}, 折叠 {stats['collapsed']} 条"
+    )
+    return stats
+
 # ============ 格式转换 ============
 
 def flatten_refs(schema: dict, defs: dict):
@@ -393,6 +1046,9 @@ def claude_to_gemini(claude_request: dict, project_id: str) -> dict:
                     if item.get("type") == "tool_use":
                         tool_id_to_name[item["id"]] = item["name"]
 
+    # thought_signature 每个请求只读一次 (多 worker 时是一次 SQLite 查询)
+    thought_signature = get_thought_signature() if is_gemini_native and tool_id_to_name else None
+
     # 4. Messages Construction
     for msg in claude_request.get("messages", []):
         role = "user" if msg["role"] == "user" else "model"
@@ -424,9 +1080,8 @@ def claude_to_gemini(claude_request: dict, project_id: str) -> dict:
                         part = {"functionCall": func_call}
                         
                         # 尝试注入 thought_signature (for Thinking models)
-                        sig = get_thought_signature()
-                        if sig:
-                            part["thoughtSignature"] = sig
+                        if thought_signature:
+                            part["thoughtSignature"] = thought_signature
                         
                         parts.append(part)
                     else:
@@ -471,28 +1126,101 @@ def claude_to_gemini(claude_request: dict, project_id: str) -> dict:
 
     return final_request
 
-def gemini_to_claude(gemini_response: dict, model: str) -> dict:
-    """Gemini 响应格式 -> Claude 格式"""
-    if "response" in gemini_response:
-        gemini_response = gemini_response["response"]
-    
-    candidates = gemini_response.get("candidates", [])
+def parse_sse_data(line: str) -> Optional[dict]:
+    """解析上游 SSE 的 data 行，去掉 Cloud Code 的 {"response": ...} 外层；非 data 行返回 None"""
+    if not line.startswith("data: "):
+        return None
+    data = json.loads(line[6:])
+    return data.get("response", data)
+
+# ============ Gemini 原生透传 ============
+def wrap_cloudcode_request(request_body: bytes, model: str, project_id: str) -> bytes:
+    """把原生 Gemini 请求体包进 Cloud Code 的请求外层，请求体本身不解析、不重新编码"""
+    envelope = json.dumps({
+        "project": project_id,
+        "requestId": f"agent-{uuid.uuid4()}",
+        "model": model,
+        "userAgent": "antigravity",
+        "requestType": "agent",
+    }, separators=(",", ":"))
+    return envelope[:-1].encode() + b',"request":' + request_body + b"}"
+
+_ENVELOPE_PREFIX = re.compile(r'\s*\{\s*"response"\s*:\s*')
+# 内层之后只能是外层的其它字段 (traceId 等) 或外层的右括号
+_ENVELOPE_AFTER_INNER = re.compile(r'\s*[,}]')
+_json_decoder = json.JSONDecoder()
+
+def _usage_metadata(data: Any) -> dict:
+    return (data.get("usageMetadata") or {}) if isinstance(data, dict) else {}
+
+def unwrap_response_envelope(text: str) -> Tuple[str, dict]:
+    """去掉 Cloud Code 响应的 {"response": ...} 外层，返回 (内层 JSON 原文, usageMetadata)
     
-    content = []
-    stop_reason = "end_turn"
+    response 是外层第一个字段时 (Cloud Code 的常见形式)，由 raw_decode 确定内层的结束位置后截取原文，
+    转发给客户端的内容不重新编码；其它形式的外层完整解析后重新编码。
+    没有外层的分块只在包含 usageMetadata 时解析。无法解析时抛出 ValueError。
+    """
+    match = _ENVELOPE_PREFIX.match(text)
+    if match:
+        data, end = _json_decoder.raw_decode(text, match.end())
+        if _ENVELOPE_AFTER_INNER.match(text, end):
+            return text[match.end():end], _usage_metadata(data)
+    elif '"response"' not in text:
+        return text, _usage_metadata(json.loads(text)) if '"usageMetadata"' in text else {}
+    data = json.loads(text)
+    if not (isinstance(data, dict) and "response" in data):
+        # 内容中恰好出现 "response" 字样，并没有外层
+        return text, _usage_metadata(data)
+    data = data["response"]
+    return json.dumps(data, ensure_ascii=False), _usage_metadata(data)
 
-    if candidates:
-        candidate = candidates[0]
-        parts = candidate.get("content", {}).get("parts", [])
-        for part in parts:
+class ClaudeMessageBuilder:
+    """把 Gemini 响应 (完整响应或流式分块) 增量拼成 Claude 格式的消息
+    
+    跨分块连续的文本合并为一个 text 块，只保留拼接所需的片段，不保存原始响应。
+    """
+    __slots__ = ("model", "content", "stop_reason", "usage_metadata", "_block", "_pieces")
+    
+    def __init__(self, model: str):
+        self.model = model
+        self.content: List[dict] = []
+        self.stop_reason = "end_turn"
+        self.usage_metadata: Dict[str, Any] = {}
+        # 末尾仍可续接的文本块；被后续分块续接时才收集片段，完整响应不需要拼接
+        self._block: Optional[dict] = None
+        self._pieces: Optional[List[str]] = None
+    
+    def add(self, gemini_response: dict):
+        if "response" in gemini_response:
+            gemini_response = gemini_response["response"]
+        # 流式时用量可能出现在多个分块中 (累计值)，保留最后一次
+        self.usage_metadata = gemini_response.get("usageMetadata") or self.usage_metadata
+        
+        candidates = gemini_response.get("candidates")
+        if not candidates:
+            return
+        content = self.content
+        # 分块开头的文本续接上一分块末尾的文本块；同一分块内的多个文本 part 各自成块 (与完整响应一致)
+        continues = self._block is not None
+        for part in candidates[0].get("content", {}).get("parts", []):
             if "thoughtSignature" in part:
-                 store_thought_signature(part["thoughtSignature"])
+                store_thought_signature(part["thoughtSignature"])
             elif "thought_signature" in part:
-                 store_thought_signature(part["thought_signature"])
-
+                store_thought_signature(part["thought_signature"])
+            
             if "text" in part:
-                content.append({"type": "text", "text": part["text"]})
+                if continues:
+                    if self._pieces is None:
+                        self._pieces = [self._block["text"]]
+                    self._pieces.append(part["text"])
+                else:
+                    if self._block is not None:
+                        self._close_text()
+                    self._block = {"type": "text", "text": part["text"]}
+                    content.append(self._block)
             elif "functionCall" in part:
+                if self._block is not None:
+                    self._close_text()
                 # Gemini 想要调用工具 -> Claude tool_use
                 fc = part["functionCall"]
                 content.append({
@@ -501,23 +1229,524 @@ def gemini_to_claude(gemini_response: dict, model: str) -> dict:
                     "name": fc["name"],
                     "input": fc["args"]
                 })
-                stop_reason = "tool_use"
+                self.stop_reason = "tool_use"
+            continues = False
     
-    usage_metadata = gemini_response.get("usageMetadata", {})
+    def _close_text(self):
+        if self._pieces is not None:
+            self._block["text"] = "".join(self._pieces)
+            self._pieces = None
+        self._block = None
     
-    return {
-        "id": f"msg_{uuid.uuid4().hex[:24]}",
-        "type": "message",
-        "role": "assistant",
-        "content": content,
-        "model": model,
-        "stop_reason": stop_reason,
-        "stop_sequence": None,
-        "usage": {
-            "input_tokens": usage_metadata.get("promptTokenCount", 0),
-            "output_tokens": usage_metadata.get("candidatesTokenCount", 0)
+    def build(self) -> dict:
+        if self._block is not None:
+            self._close_text()
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "content": self.content,
+            "model": self.model,
+            "stop_reason": self.stop_reason,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": self.usage_metadata.get("promptTokenCount", 0),
+                "output_tokens": self.usage_metadata.get("candidatesTokenCount", 0)
+            }
         }
-    }
+
+def gemini_to_claude(gemini_response: dict, model: str) -> dict:
+    """Gemini 响应格式 -> Claude 格式"""
+    builder = ClaudeMessageBuilder(model)
+    builder.add(gemini_response)
+    return builder.build()
+
+# ============ 性能分析 ============
+class StageTimer:
+    """记录单个请求各阶段耗时，输出为 Server-Timing 格式"""
+    __slots__ = ("stages", "_start")
+    
+    def __init__(self):
+        self.stages: List[tuple] = []
+        self._start = time.perf_counter()
+    
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.perf_counter() - start) * 1000))
+    
+    def add(self, name: str, start: float):
+        """记录从 start (perf_counter) 到现在的耗时"""
+        self.stages.append((name, (time.perf_counter() - start) * 1000))
+    
+    def header(self) -> str:
+        total = (time.perf_counter() - self._start) * 1000
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages + [("total", total)])
+    
+    def as_dict(self) -> Dict[str, float]:
+        result = {name: round(ms, 1) for name, ms in self.stages}
+        result["total"] = round((time.perf_counter() - self._start) * 1000, 1)
+        return result
+
+def require_admin(request: Request):
+    """管理端点鉴权：配置了 admin_key 时校验 X-Admin-Key，否则只允许本机 (含 Unix Socket) 访问"""
+    if ADMIN_KEY:
+        if not hmac.compare_digest(request.headers.get("x-admin-key", ""), ADMIN_KEY):
+            raise HTTPException(403, "Invalid admin key")
+        return
+    host = request.client.host if request.client else ""
+    if host not in ("", "127.0.0.1", "::1", "localhost"):
+        raise HTTPException(403, "Admin endpoints are restricted to localhost")
+
+class SamplingProfiler:
+    """采样式分析器：后台线程定期抓取事件循环线程的调用栈并统计热点"""
+    
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.self_counts: Counter = Counter()
+        self.total_counts: Counter = Counter()
+        self._stop = threading.Event()
+    
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            key = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"
+            if leaf:
+                self.self_counts[key] += 1
+                leaf = False
+            # 递归函数在一个样本中只计一次
+            if key not in seen:
+                self.total_counts[key] += 1
+                seen.add(key)
+            frame = frame.f_back
+    
+    def run(self, duration: float):
+        deadline = time.perf_counter() + duration
+        while not self._stop.is_set() and time.perf_counter() < deadline:
+            self._sample()
+            self._stop.wait(self.interval)
+    
+    def report(self, top: int) -> dict:
+        def rank(counter: Counter) -> List[dict]:
+            return [
+                {"function": key, "samples": n, "percent": round(n * 100 / self.samples, 1)}
+                for key, n in counter.most_common(top)
+            ]
+        return {
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "self": rank(self.self_counts) if self.samples else [],
+            "cumulative": rank(self.total_counts) if self.samples else [],
+        }
+
+_profile_lock = asyncio.Lock()
+
+# ============ 流量录制 ============
+# 结构性字段在脱敏时保留原值，保证记录仍可被正确回放
+CAPTURE_KEEP_KEYS = {"type", "role", "id", "tool_use_id", "name", "media_type", "mimeType", "model", "finishReason"}
+
+def redact(value: Any, fields: set, masking: bool = False) -> Any:
+    """返回脱敏后的副本：fields 中字段下的字符串替换为等长的 "x" """
+    if isinstance(value, dict):
+        return {
+            k: v if masking and k in CAPTURE_KEEP_KEYS else redact(v, fields, masking or k in fields)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v, fields, masking) for v in value]
+    if masking and isinstance(value, str):
+        return "x" * len(value)
+    return value
+
+def _redact_sse_line(line: str, fields: set) -> str:
+    if not line.startswith("data: "):
+        return line
+    try:
+        return "data: " + json.dumps(redact(json.loads(line[6:]), fields), ensure_ascii=False)
+    except ValueError:
+        return line
+
+class CaptureWriter:
+    """流量录制：请求路径只做入队 (队列满则丢弃)，后台线程批量脱敏并追加写入 JSONL"""
+    
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.written = 0
+        self.dropped = 0
+    
+    def sample(self) -> bool:
+        return self.queue is not None and random.random() < CAPTURE["sample_rate"]
+    
+    def submit(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+    
+    async def run(self):
+        self.queue = asyncio.Queue(maxsize=CAPTURE["queue_size"])
+        print(f"[Capture] 录制已开启 -> {CAPTURE['path']} (采样率 {CAPTURE['sample_rate']})")
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while not self.queue.empty() and len(batch) < 100:
+                    batch.append(self.queue.get_nowait())
+                await asyncio.to_thread(self._write, batch)
+        finally:
+            # 退出时写完队列中剩余的记录
+            remaining = []
+            while not self.queue.empty():
+                remaining.append(self.queue.get_nowait())
+            if remaining:
+                self._write(remaining)
+            self.queue = None
+    
+    def _write(self, batch: List[dict]):
+        fields = set(CAPTURE["redact"])
+        lines = []
+        for record in batch:
+            record["request"] = redact(record["request"], fields)
+            upstream = record.get("upstream", {})
+            if "body" in upstream:
+                upstream["body"] = redact(upstream["body"], fields)
+            if "chunks" in upstream:
+                upstream["chunks"] = [[t, _redact_sse_line(line, fields)] for t, line in upstream["chunks"]]
+            lines.append(json.dumps(record, ensure_ascii=False))
+        data = ("\n".join(lines) + "\n").encode()
+        
+        try:
+            fd = os.open(CAPTURE["path"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                # 多 worker 同时追加时互斥，避免行交错
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+            self.written += len(batch)
+        except OSError as e:
+            print(f"[Capture] 写入失败: {e}")
+
+CAPTURER = CaptureWriter()
+
+# ============ 用量统计 ============
+# 用量按分钟聚合存储
+USAGE_BUCKET_SECONDS = 60
+
+def client_id(request: Request) -> str:
+    """根据 x-api-key / x-goog-api-key / ?key= 或 Authorization: Bearer 识别客户端，不保存 Key 原文"""
+    key = (request.headers.get("x-api-key") or request.headers.get("x-goog-api-key")
+           or request.query_params.get("key"))
+    if not key:
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            key = auth[7:].strip()
+    if not key:
+        return "anonymous"
+    return USAGE["clients"].get(key) or f"key-{hashlib.sha256(key.encode()).hexdigest()[:12]}"
+
+def parse_duration(value: str) -> int:
+    """解析 "90s" / "15m" / "24h" / "7d" 为秒数"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    try:
+        seconds = int(value[:-1]) * units[value[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise HTTPException(400, f"Invalid duration: {value!r}")
+    if seconds <= 0:
+        raise HTTPException(400, f"Invalid duration: {value!r}")
+    return seconds
+
+class UsageLog:
+    """用量计数器：请求路径只更新内存中的 dict，后台任务定期把增量批量累加到 SQLite
+    
+    多个 worker 各自写入自己的增量，表中的值即为全部 worker 的合计。
+    """
+    
+    def __init__(self, state: SharedState):
+        self.state = state
+        # (分钟, client, model) -> [requests, errors, input_tokens, output_tokens]
+        self.pending: Dict[tuple, List[int]] = {}
+        self._table_ready = False
+    
+    def record(self, client: str, model: str, input_tokens: int = 0, output_tokens: int = 0, error: bool = False):
+        if not USAGE["enabled"]:
+            return
+        bucket = int(time.time()) // USAGE_BUCKET_SECONDS * USAGE_BUCKET_SECONDS
+        counters = self.pending.setdefault((bucket, client, model), [0, 0, 0, 0])
+        counters[0] += 1
+        counters[1] += int(error)
+        counters[2] += input_tokens
+        counters[3] += output_tokens
+    
+    def _ensure_table(self):
+        if not self._table_ready:
+            self.state.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "bucket INTEGER NOT NULL, client TEXT NOT NULL, model TEXT NOT NULL, "
+                "requests INTEGER NOT NULL, errors INTEGER NOT NULL, "
+                "input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (bucket, client, model))"
+            )
+            self._table_ready = True
+    
+    def _write(self, pending: Dict[tuple, List[int]]):
+        self._ensure_table()
+        self.state.executemany(
+            "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(bucket, client, model) DO UPDATE SET "
+            "requests = requests + excluded.requests, errors = errors + excluded.errors, "
+            "input_tokens = input_tokens + excluded.input_tokens, "
+            "output_tokens = output_tokens + excluded.output_tokens",
+            [(*key, *counters) for key, counters in pending.items()]
+        )
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        # 在事件循环线程中换出待写入的计数，写库放到线程中执行
+        pending, self.pending = self.pending, {}
+        try:
+            await asyncio.to_thread(self._write, pending)
+        except sqlite3.Error as e:
+            print(f"[Usage] 写入失败: {e}")
+            # 放回内存，下次重试
+            for key, counters in pending.items():
+                merged = self.pending.setdefault(key, [0, 0, 0, 0])
+                for i, value in enumerate(counters):
+                    merged[i] += value
+    
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(USAGE["flush_interval"])
+                await self.flush()
+        finally:
+            # 退出时写入剩余计数
+            if self.pending:
+                try:
+                    self._write(self.pending)
+                    self.pending = {}
+                except sqlite3.Error as e:
+                    print(f"[Usage] 写入失败: {e}")
+    
+    def query(self, since: float, interval: Optional[int], group_by: List[str]) -> List[dict]:
+        self._ensure_table()
+        columns = list(group_by)
+        if interval:
+            columns.insert(0, f"bucket - bucket % {int(interval)} AS start")
+        select = ", ".join(columns + [
+            "SUM(requests)", "SUM(errors)", "SUM(input_tokens)", "SUM(output_tokens)"
+        ])
+        group = f" GROUP BY {', '.join(str(i + 1) for i in range(len(columns)))}" if columns else ""
+        rows = self.state.execute(
+            f"SELECT {select} FROM usage WHERE bucket >= ?{group} ORDER BY 1",
+            (int(since) // USAGE_BUCKET_SECONDS * USAGE_BUCKET_SECONDS,)
+        )
+        names = (["start"] if interval else []) + list(group_by)
+        result = []
+        for row in rows:
+            item = dict(zip(names, row))
+            item.update(zip(("requests", "errors", "input_tokens", "output_tokens"), row[len(names):]))
+            result.append(item)
+        return result
+
+USAGE_LOG = UsageLog(STATE)
+
+# ============ 压缩 ============
+# 服务端偏好顺序：zstd > br > gzip (未安装的算法不参与协商)
+AVAILABLE_ENCODINGS = [
+    name for name, available in (("zstd", zstandard), ("br", brotli), ("gzip", True)) if available
+]
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """根据 Accept-Encoding 选择压缩算法，无可用算法返回 None"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in AVAILABLE_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+class StreamCompressor:
+    """流式压缩器，统一 gzip / br / zstd 的接口"""
+    
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=4)
+        else:
+            # wbits=31: 带 gzip 头
+            self._obj = zlib.compressobj(5, zlib.DEFLATED, 31)
+    
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """压缩一段数据；flush=True 时把已有数据全部刷出，客户端可立即解码"""
+        if self.encoding == "br":
+            out = self._obj.process(data)
+            return out + self._obj.flush() if flush else out
+        out = self._obj.compress(data)
+        if flush:
+            if self.encoding == "zstd":
+                out += self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            else:
+                out += self._obj.flush(zlib.Z_SYNC_FLUSH)
+        return out
+    
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+class CompressionMiddleware:
+    """下游响应压缩 (纯 ASGI 中间件，不缓冲流式响应)
+    
+    普通响应超过 min_size 才压缩；SSE 需开启 compression.sse，每个事件压缩后立即 flush。
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION["enabled"]:
+            await self.app(scope, receive, send)
+            return
+        
+        accept_encoding = ""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message = None
+        compressor: Optional[StreamCompressor] = None
+        passthrough = False
+        flush_each = False
+        
+        async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough, flush_each
+            
+            if message["type"] == "http.response.start":
+                # 先暂存，等看到第一段 body 再决定是否压缩
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            
+            if compressor is None:
+                headers = MutableHeaders(raw=list(start_message["headers"]))
+                is_sse = headers.get("content-type", "").startswith("text/event-stream")
+                if ("content-encoding" in headers
+                        or (is_sse and not COMPRESSION["sse"])
+                        or (not is_sse and not more_body and len(body) < COMPRESSION["min_size"])):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                
+                compressor = StreamCompressor(encoding)
+                flush_each = is_sse
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                    start_message["headers"] = headers.raw
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                start_message["headers"] = headers.raw
+                await send(start_message)
+            
+            data = compressor.compress(body, flush=flush_each and more_body)
+            if not more_body:
+                data += compressor.finish()
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+        
+        await self.app(scope, receive, send_wrapper)
+
+def encode_upstream_body(body: Any) -> tuple:
+    """序列化上游请求体 (已是 bytes 时原样使用)，返回 (bytes, headers)；开启 compression.upstream 且超过阈值时 gzip 压缩"""
+    data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
+    headers = {"Content-Type": "application/json"}
+    if COMPRESSION["upstream"] and len(data) >= COMPRESSION["upstream_min_size"]:
+        data = gzip.compress(data, compresslevel=5, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return data, headers
+
+# ============ 流式聚合 ============
+async def aggregate_upstream(body: bytes, headers: Dict[str, str], model: str, timer: StageTimer,
+                             chunks: Optional[list] = None) -> Tuple[int, Any]:
+    """以 streamGenerateContent 读取上游并边读边拼装 Claude 响应，返回 (状态码, Claude 响应或错误文本)
+    
+    上游空闲超过 idle_timeout 秒即中断。读取中途失败时客户端尚未收到任何数据，换端点整体重试；
+    重试用尽后超时返回 504、其它传输错误返回 502，与上游的错误状态码一样交给调用方处理。
+    chunks 不为 None 时记录上游 SSE 行及到达时间 (流量录制)。
+    """
+    timeout = httpx.Timeout(STREAM_AGGREGATE["idle_timeout"], connect=30)
+    attempted: List[Endpoint] = []
+    for attempt in range(STREAM_AGGREGATE["retries"] + 1):
+        builder = ClaudeMessageBuilder(model)
+        if chunks is not None:
+            chunks.clear()
+        upstream_start = time.perf_counter()
+        try:
+            async with upstream_request("streamGenerateContent", body, headers, "alt=sse",
+                                        timeout=timeout, attempted=attempted) as resp:
+                timer.add("ttfb", upstream_start)
+                if resp.status_code != 200:
+                    return resp.status_code, (await resp.aread()).decode(errors="replace")
+                stream_start = time.perf_counter()
+                async for line in resp.aiter_lines():
+                    if chunks is not None and line:
+                        chunks.append([round((time.perf_counter() - stream_start) * 1000, 1), line])
+                    try:
+                        data = parse_sse_data(line)
+                    except Exception as e:
+                        # 与流式响应一致：跳过无法解析的分块
+                        print(f"[Aggregate Parse Error] {e}")
+                        continue
+                    if data is not None:
+                        builder.add(data)
+                timer.add("stream", stream_start)
+            return 200, builder.build()
+        except httpx.TransportError as e:
+            if attempt == STREAM_AGGREGATE["retries"]:
+                if isinstance(e, httpx.TimeoutException):
+                    return 504, f"Upstream timed out ({type(e).__name__})"
+                return 502, f"Upstream stream failed ({type(e).__name__}: {e})"
+            print(f"[Aggregate] 上游读取中断 ({type(e).__name__})，重试")
 
 # ============ 请求模型 ============
 class Message(BaseModel):
@@ -535,9 +1764,21 @@ class ChatRequest(BaseModel):
     tool_choice: Optional[Any] = None
 
 # ============ API 端点 ============
+app = FastAPI(title="Antigravity API Server", lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    # 预热完成前和 drain 期间返回 503，避免启动脚本/负载均衡把流量导入
+    # pid 供 start-server.sh 在新旧进程共用端口时分辨应答的是哪个进程
+    if _draining:
+        return JSONResponse({"status": "draining", "pid": os.getpid(), "active_streams": _active_streams},
+                            status_code=503)
+    if not _ready:
+        return JSONResponse({"status": "warming", "pid": os.getpid()}, status_code=503)
+    if _warmup_error:
+        return {"status": "ok", "pid": os.getpid(), "warmup_error": _warmup_error}
+    return {"status": "ok", "pid": os.getpid()}
 
 @app.get("/v1/models")
 async def list_models():
@@ -550,126 +1791,360 @@ async def list_models():
         ]
     }
 
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10, interval_ms: float = 5, top: int = 30):
+    """对当前 worker 的实时流量采样 N 秒，返回热点函数 (self / cumulative)"""
+    require_admin(request)
+    if _profile_lock.locked():
+        raise HTTPException(409, "Profiler is already running")
+    
+    seconds = min(max(seconds, 0.1), 120)
+    async with _profile_lock:
+        profiler = SamplingProfiler(threading.get_ident(), max(interval_ms, 1) / 1000)
+        await asyncio.to_thread(profiler.run, seconds)
+    
+    report = profiler.report(top)
+    report["seconds"] = seconds
+    report["pid"] = os.getpid()
+    return report
+
+@app.get("/debug/endpoints")
+async def debug_endpoints(request: Request):
+    """各 Cloud Code 端点的健康状态、延迟与错误统计 (当前 worker)"""
+    require_admin(request)
+    return {"pid": os.getpid(), "endpoints": [e.stats() for e in ENDPOINTS]}
+
+@app.post("/debug/drain")
+async def debug_drain(request: Request):
+    """平滑退出整个服务，效果与向主进程发送 SIGTERM 相同"""
+    require_admin(request)
+    begin_drain("管理端点")
+    # 多 worker 时由 uvicorn 主进程把 SIGTERM 转发给全部 worker
+    target = os.getppid() if WORKERS > 1 else os.getpid()
+    asyncio.get_running_loop().call_later(0.1, os.kill, target, signal.SIGTERM)
+    return {"status": "draining", "pid": target, "active_streams": _active_streams}
+
+@app.get("/debug/usage")
+async def debug_usage(request: Request, window: str = "24h", interval: Optional[str] = None,
+                      group_by: str = "client,model"):
+    """查询最近 window 内的用量合计，可按 client / model 分组、按 interval 分段"""
+    require_admin(request)
+    if not USAGE["enabled"]:
+        raise HTTPException(404, "Usage accounting is disabled")
+    fields = [f for f in group_by.split(",") if f]
+    if any(f not in ("client", "model") for f in fields):
+        raise HTTPException(400, "group_by must be a combination of client, model")
+    since = time.time() - parse_duration(window)
+    step = parse_duration(interval) if interval else None
+    
+    # 先写入当前 worker 未落盘的计数；其它 worker 的计数最多延迟 flush_interval 秒
+    await USAGE_LOG.flush()
+    rows = await asyncio.to_thread(USAGE_LOG.query, since, step, fields)
+    return {"window": window, "since": int(since), "flush_interval": USAGE["flush_interval"], "data": rows}
+
 @app.post("/v1/messages")
-async def messages(request: ChatRequest):
+async def messages(request: ChatRequest, http_request: Request):
     """Anthropic Messages API 兼容接口"""
+    if _draining:
+        raise HTTPException(503, "Server is draining")
+    client = client_id(http_request)
+    timer = StageTimer()
     
-    access_token = await get_access_token()
-    project_id = await get_project_id()
+    with timer.stage("token"):
+        access_token = await get_access_token()
+    with timer.stage("project"):
+        project_id = await get_project_id()
     
     request_dict = request.model_dump()
-    gemini_body = claude_to_gemini(request_dict, project_id)
+    # 录制原始请求 (压缩/转换会就地修改 request_dict，因此另存一份)
+    capture = None
+    if CAPTURER.sample():
+        capture = {"id": uuid.uuid4().hex, "ts": time.time(), "stream": bool(request.stream),
+                   "request": request.model_dump()}
+    extra_headers = {}
+    if COMPACTION["enabled"]:
+        with timer.stage("compact"):
+            compaction = compact_request(request_dict)
+        if compaction:
+            extra_headers["X-Compaction"] = (
+                f"saved-bytes={compaction['saved_bytes']}; saved-tokens={compaction['saved_tokens']}"
+            )
     
-    method = "streamGenerateContent" if request.stream else "generateContent"
-    query = "alt=sse" if request.stream else ""
+    with timer.stage("translate"):
+        gemini_body = claude_to_gemini(request_dict, project_id)
+    with timer.stage("encode"):
+        upstream_body, body_headers = encode_upstream_body(gemini_body)
     
-    url = f"{CLOUDCODE_API}:{method}"
-    if query:
-        url += f"?{query}"
+    # 聚合模式下非流式请求也走 streamGenerateContent
+    aggregate = not request.stream and STREAM_AGGREGATE["enabled"]
+    method = "streamGenerateContent" if request.stream or aggregate else "generateContent"
+    query = "alt=sse" if method == "streamGenerateContent" else ""
     
     headers = {
         "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "User-Agent": USER_AGENT
+        "User-Agent": USER_AGENT,
+        **body_headers
     }
     
     print(f"[Request] {method} -> {gemini_body.get('model')} (stream={request.stream})")
     
     if request.stream:
-        # 流式响应 - 客户端必须在生成器内部创建！
+        # 流式响应 - 使用共享连接池，连接在生成器结束后归还
         async def generate():
-            async with httpx.AsyncClient(timeout=600) as client:
-                try:
-                    async with client.stream("POST", url, json=gemini_body, headers=headers) as resp:
-                        if resp.status_code != 200:
-                            error_text = await resp.aread()
-                            yield f'data: {{"type":"error","error":{{"message":"Error {resp.status_code}"}}}}\n\n'
-                            return
+            global _active_streams
+            # 录制时保存上游 SSE 行及其相对响应头的到达时间 (ms)
+            chunks = [] if capture else None
+            status = None
+            usage_metadata = {}
+            failed = False
+            _active_streams += 1
+            try:
+                upstream_start = time.perf_counter()
+                async with upstream_request(method, upstream_body, headers, query) as resp:
+                    timer.add("ttfb", upstream_start)
+                    stream_start = time.perf_counter()
+                    status = resp.status_code
+                    if resp.status_code != 200:
+                        error_text = await resp.aread()
+                        if chunks is not None:
+                            chunks.append([0, error_text.decode(errors="replace")])
+                        if resp.status_code == 401:
+                            invalidate_access_token()
+                        yield f'data: {{"type":"error","error":{{"message":"Error {resp.status_code}"}}}}\n\n'
+                        return
                         
-                        msg_id = f"msg_{uuid.uuid4().hex[:24]}"
-                        yield f'data: {{"type":"message_start","message":{{"id":"{msg_id}","type":"message","role":"assistant","content":[],"model":"{request.model}"}}}}\n\n'
+                    msg_id = f"msg_{uuid.uuid4().hex[:24]}"
+                    yield f'data: {{"type":"message_start","message":{{"id":"{msg_id}","type":"message","role":"assistant","content":[],"model":"{request.model}"}}}}\n\n'
                         
-                        # 内容块索引
-                        block_index = 0
-                        # 记录当前是否正在流式传输文本块
-                        in_text_block = False
+                    # 内容块索引
+                    block_index = 0
+                    # 记录当前是否正在流式传输文本块
+                    in_text_block = False
                         
-                        async for line in resp.aiter_lines():
-                            if line.startswith("data: "):
-                                try:
-                                    data = json.loads(line[6:])
-                                    candidates = data.get("candidates", [])
-                                    if candidates:
-                                        parts = candidates[0].get("content", {}).get("parts", [])
-                                        for part in parts:
-                                            # [NEW] Capture thought_signature from stream chunk
-                                            if "thoughtSignature" in part:
-                                                store_thought_signature(part["thoughtSignature"])
-                                            elif "thought_signature" in part:
-                                                store_thought_signature(part["thought_signature"])
-
-                                            # 处理文本
-                                            if "text" in part:
-                                                text = part["text"]
-                                                if not in_text_block:
-                                                    yield f'data: {{"type":"content_block_start","index":{block_index},"content_block":{{"type":"text","text":""}}}}\n\n'
-                                                    in_text_block = True
+                    async for line in resp.aiter_lines():
+                        if chunks is not None and line:
+                            chunks.append([round((time.perf_counter() - stream_start) * 1000, 1), line])
+                        if line.startswith("data: "):
+                            try:
+                                data = parse_sse_data(line)
+                                # 用量在最后的分块中给出 (中间分块可能带累计值)，保留最后一次
+                                usage_metadata = data.get("usageMetadata") or usage_metadata
+                                candidates = data.get("candidates", [])
+                                if candidates:
+                                    parts = candidates[0].get("content", {}).get("parts", [])
+                                    for part in parts:
+                                        # [NEW] Capture thought_signature from stream chunk
+                                        if "thoughtSignature" in part:
+                                            store_thought_signature(part["thoughtSignature"])
+                                        elif "thought_signature" in part:
+                                            store_thought_signature(part["thought_signature"])
+
+                                        # 处理文本
+                                        if "text" in part:
+                                            text = part["text"]
+                                            if not in_text_block:
+                                                yield f'data: {{"type":"content_block_start","index":{block_index},"content_block":{{"type":"text","text":""}}}}\n\n'
+                                                in_text_block = True
                                                 
-                                                escaped = json.dumps(text)
-                                                yield f'data: {{"type":"content_block_delta","index":{block_index},"delta":{{"type":"text_delta","text":{escaped}}}}}\n\n'
+                                            escaped = json.dumps(text)
+                                            yield f'data: {{"type":"content_block_delta","index":{block_index},"delta":{{"type":"text_delta","text":{escaped}}}}}\n\n'
                                             
-                                            # 处理函数调用
-                                            elif "functionCall" in part:
-                                                if in_text_block:
-                                                    yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
-                                                    block_index += 1
-                                                    in_text_block = False
+                                        # 处理函数调用
+                                        elif "functionCall" in part:
+                                            if in_text_block:
+                                                yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
+                                                block_index += 1
+                                                in_text_block = False
                                                 
-                                                fc = part["functionCall"]
-                                                tool_id = f"call_{uuid.uuid4().hex[:16]}"
-                                                name_json = json.dumps(fc["name"])
+                                            fc = part["functionCall"]
+                                            tool_id = f"call_{uuid.uuid4().hex[:16]}"
+                                            name_json = json.dumps(fc["name"])
                                                 
-                                                # 开始 Tool Block
-                                                yield f'data: {{"type":"content_block_start","index":{block_index},"content_block":{{"type":"tool_use","id":"{tool_id}","name":{name_json},"input":{{}}}}}}\n\n'
+                                            # 开始 Tool Block
+                                            yield f'data: {{"type":"content_block_start","index":{block_index},"content_block":{{"type":"tool_use","id":"{tool_id}","name":{name_json},"input":{{}}}}}}\n\n'
                                                 
-                                                # 发送参数 (Gemini 返回的是对象，我们转回 JSON 字符串发送)
-                                                args_json = json.dumps(fc["args"])
-                                                escaped_args = json.dumps(args_json) # 再次转义作为 JSON 字符串的值
-                                                yield f'data: {{"type":"content_block_delta","index":{block_index},"delta":{{"type":"input_json_delta","partial_json":{escaped_args}}}}}\n\n'
+                                            # 发送参数 (Gemini 返回的是对象，我们转回 JSON 字符串发送)
+                                            args_json = json.dumps(fc["args"])
+                                            escaped_args = json.dumps(args_json) # 再次转义作为 JSON 字符串的值
+                                            yield f'data: {{"type":"content_block_delta","index":{block_index},"delta":{{"type":"input_json_delta","partial_json":{escaped_args}}}}}\n\n'
                                                 
-                                                # 结束 Tool Block
-                                                yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
-                                                block_index += 1
+                                            # 结束 Tool Block
+                                            yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
+                                            block_index += 1
                                                 
-                                                # 记录停止原因
-                                                yield f'data: {{"type":"message_delta","delta":{{"stop_reason":"tool_use"}}}}\n\n'
+                                            # 记录停止原因
+                                            yield f'data: {{"type":"message_delta","delta":{{"stop_reason":"tool_use"}}}}\n\n'
 
-                                except Exception as e:
-                                    print(f"[Stream Parse Error] {e}")
+                            except Exception as e:
+                                print(f"[Stream Parse Error] {e}")
                         
-                        if in_text_block:
-                            yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
+                    if in_text_block:
+                        yield f'data: {{"type":"content_block_stop","index":{block_index}}}\n\n'
                         
-                        yield f'data: {{"type":"message_delta","delta":{{"stop_reason":"end_turn"}}}}\n\n'
-                        yield f'data: {{"type":"message_stop"}}\n\n'
-                except Exception as e:
-                    print(f"[Stream Error] {e}")
-                    yield f'data: {{"type":"error","error":{{"message":"{str(e)}"}}}}\n\n'
+                    usage_json = json.dumps({
+                        "input_tokens": usage_metadata.get("promptTokenCount", 0),
+                        "output_tokens": usage_metadata.get("candidatesTokenCount", 0),
+                    })
+                    yield f'data: {{"type":"message_delta","delta":{{"stop_reason":"end_turn"}},"usage":{usage_json}}}\n\n'
+                    yield f'data: {{"type":"message_stop"}}\n\n'
+                    # 响应头已发出，流式阶段的耗时以 SSE 注释附在末尾
+                    timer.add("stream", stream_start)
+                    yield f": server-timing {timer.header()}\n\n"
+            except Exception as e:
+                failed = True
+                print(f"[Stream Error] {e}")
+                yield f'data: {{"type":"error","error":{{"message":"{str(e)}"}}}}\n\n'
+            finally:
+                _active_streams -= 1
+                USAGE_LOG.record(client, gemini_body.get("model"),
+                                 usage_metadata.get("promptTokenCount", 0),
+                                 usage_metadata.get("candidatesTokenCount", 0),
+                                 error=failed or status != 200)
+                if capture:
+                    capture["upstream"] = {"status": status, "chunks": chunks}
+                    capture["timings"] = timer.as_dict()
+                    CAPTURER.submit(capture)
         
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        # 响应头中先给出流开始前的各阶段耗时
+        return StreamingResponse(generate(), media_type="text/event-stream",
+                                 headers={"Server-Timing": timer.header(), **extra_headers})
     else:
         # 非流式
-        async with httpx.AsyncClient(timeout=600) as client:
-            resp = await client.post(url, json=gemini_body, headers=headers)
-            
-            if resp.status_code != 200:
-                print(f"[Error] {resp.status_code}: {resp.text}")
-                raise HTTPException(resp.status_code, resp.text)
-            
-            gemini_resp = resp.json()
-            claude_resp = gemini_to_claude(gemini_resp, request.model)
-            
-            return claude_resp
+        if aggregate:
+            chunks = [] if capture else None
+            status, result = await aggregate_upstream(upstream_body, headers, request.model, timer, chunks)
+            error_text = None if status == 200 else result
+            if capture:
+                capture["upstream"] = {"status": status, "chunks": chunks if error_text is None else [[0, error_text]]}
+        else:
+            upstream_start = time.perf_counter()
+            async with upstream_request(method, upstream_body, headers) as resp:
+                timer.add("ttfb", upstream_start)
+                with timer.stage("download"):
+                    await resp.aread()
+            status = resp.status_code
+            error_text = None if status == 200 else resp.text
+            if error_text is None:
+                with timer.stage("decode"):
+                    gemini_resp = resp.json()
+                    result = gemini_to_claude(gemini_resp, request.model)
+            if capture:
+                capture["upstream"] = {"status": status, "body": gemini_resp} if error_text is None else \
+                                      {"status": status, "text": error_text}
+        
+        if capture:
+            capture["timings"] = timer.as_dict()
+            CAPTURER.submit(capture)
+        
+        if error_text is not None:
+            print(f"[Error] {status}: {error_text}")
+            USAGE_LOG.record(client, gemini_body.get("model"), error=True)
+            if status == 401:
+                invalidate_access_token()
+            raise HTTPException(status, error_text)
+        
+        USAGE_LOG.record(client, gemini_body.get("model"),
+                         result["usage"]["input_tokens"], result["usage"]["output_tokens"])
+        return JSONResponse(result, headers={"Server-Timing": timer.header(), **extra_headers})
+
+@app.post("/v1beta/models/{model}:{action}")
+async def gemini_native(model: str, action: str, http_request: Request):
+    """Gemini API 原生接口：请求体只包上 Cloud Code 外层，响应只去掉外层，不做 Claude 格式转换"""
+    if action not in ("generateContent", "streamGenerateContent"):
+        raise HTTPException(404, f"Unsupported method: {action}")
+    if _draining:
+        raise HTTPException(503, "Server is draining")
+    client = client_id(http_request)
+    timer = StageTimer()
+    
+    body = await http_request.body()
+    if not body.lstrip().startswith(b"{"):
+        raise HTTPException(400, "Request body must be a JSON object")
+    
+    with timer.stage("token"):
+        access_token = await get_access_token()
+    with timer.stage("project"):
+        project_id = await get_project_id()
+    with timer.stage("encode"):
+        upstream_body, body_headers = encode_upstream_body(wrap_cloudcode_request(body, model, project_id))
+    
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "User-Agent": USER_AGENT,
+        **body_headers
+    }
+    stream = action == "streamGenerateContent"
+    print(f"[Native] {action} -> {model}")
+    
+    # 在返回响应之前完成上游请求：失败时可切换端点，错误按上游状态码原样返回给客户端
+    stack = AsyncExitStack()
+    attempted: List[Endpoint] = []
+    upstream_start = time.perf_counter()
+    resp = await stack.enter_async_context(
+        upstream_request(action, upstream_body, headers, "alt=sse" if stream else "", attempted=attempted)
+    )
+    timer.add("ttfb", upstream_start)
+    
+    if resp.status_code != 200 or not stream:
+        try:
+            with timer.stage("download"):
+                await resp.aread()
+        finally:
+            await stack.aclose()
+        if resp.status_code != 200:
+            print(f"[Error] {resp.status_code}: {resp.text}")
+            USAGE_LOG.record(client, model, error=True)
+            if resp.status_code == 401:
+                invalidate_access_token()
+            return Response(resp.content, status_code=resp.status_code,
+                            media_type=resp.headers.get("content-type", "application/json"))
+        
+        try:
+            with timer.stage("unwrap"):
+                text, usage = unwrap_response_envelope(resp.text)
+        except ValueError as e:
+            # 无法解析的响应体原样转发
+            print(f"[Parse Error] {e}")
+            text, usage = resp.content, {}
+        USAGE_LOG.record(client, model, usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0))
+        return Response(text, media_type="application/json", headers={"Server-Timing": timer.header()})
+    
+    async def generate():
+        global _active_streams
+        usage = {}
+        failed = False
+        _active_streams += 1
+        try:
+            stream_start = time.perf_counter()
+            async for line in resp.aiter_lines():
+                if line.startswith("data: "):
+                    try:
+                        text, chunk_usage = unwrap_response_envelope(line[6:])
+                    except ValueError as e:
+                        # 无法解析的数据行原样转发，不中断流
+                        print(f"[Stream Parse Error] {e}")
+                        yield f"{line}\n"
+                        continue
+                    usage = chunk_usage or usage
+                    yield f"data: {text}\n"
+                else:
+                    yield f"{line}\n"
+            timer.add("stream", stream_start)
+            yield f": server-timing {timer.header()}\n\n"
+        except httpx.TransportError as e:
+            # 已开始向客户端转发，无法切换端点，只计入被动检测
+            failed = True
+            attempted[-1].record_failure(f"{type(e).__name__}: {e}", request=False)
+            print(f"[Stream Error] {e}")
+        finally:
+            _active_streams -= 1
+            USAGE_LOG.record(client, model, usage.get("promptTokenCount", 0),
+                             usage.get("candidatesTokenCount", 0), error=failed)
+            await stack.aclose()
+    
+    # 生成器未被迭代 (客户端提前断开) 时由 background 归还连接；aclose 可重复调用
+    return StreamingResponse(generate(), media_type="text/event-stream",
+                             headers={"Server-Timing": timer.header()}, background=BackgroundTask(stack.aclose))
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
@@ -684,22 +2159,115 @@ async def chat_completions(request: Request):
         stream=body.get("stream", False)
     )
     
-    return await messages(claude_req)
+    return await messages(claude_req, request)
 
 # ============ 启动 ============
-if __name__ == "__main__":
+def build_server_options(port: int) -> Dict[str, Any]:
+    """根据 server.profile 生成 uvicorn.Config 参数
+    
+    default: 监听 0.0.0.0:port，其余沿用 uvicorn 默认值
+    fast:    显式使用 uvloop/httptools (已安装时)，加大 backlog 和 keep-alive，关闭 access log
+    配置 server.uds 后改为监听 Unix domain socket (两种 profile 均适用)
+    """
+    server_cfg = CONFIG.get("server", {})
+    profile = os.environ.get("ANTIGRAVITY_PROFILE", server_cfg.get("profile", "default"))
+    uds = os.environ.get("ANTIGRAVITY_UDS", server_cfg.get("uds"))
+    
+    if uds:
+        options = {"uds": uds}
+    else:
+        options = {"host": "0.0.0.0", "port": port}
+    # 退出时等待在途请求的上限
+    options["timeout_graceful_shutdown"] = DRAIN["timeout"]
+    
+    if profile == "fast":
+        has_uvloop = importlib.util.find_spec("uvloop") is not None
+        has_httptools = importlib.util.find_spec("httptools") is not None
+        options.update({
+            "loop": "uvloop" if has_uvloop else "asyncio",
+            "http": "httptools" if has_httptools else "h11",
+            "backlog": server_cfg.get("backlog", 4096),
+            # Claude CLI 两轮对话之间常有数十秒空闲，默认 5s 会频繁重连
+            "timeout_keep_alive": server_cfg.get("keepalive", 75),
+            "access_log": False,
+        })
+        if not (has_uvloop and has_httptools):
+            print("[Server] fast profile: 未安装 uvloop/httptools，回退到 asyncio/h11 (pip install uvloop httptools)")
+    elif profile != "default":
+        print(f"[Server] 未知 profile '{profile}'，使用 default")
+    
+    return options
+
+def bind_listen_socket(options: Dict[str, Any]) -> socket.socket:
+    """自行创建监听 socket 交给 uvicorn，使新进程能在旧进程 drain 期间接管流量
+    
+    TCP: 设置 SO_REUSEPORT，新旧进程可同时绑定同一端口，旧进程关闭监听后流量全部进入新进程
+    UDS: 先绑定临时路径再原子替换，新连接立即进入新进程，旧进程已有的连接不受影响
+    会从 options 中移除 host/port/uds。
+    """
+    uds = options.pop("uds", None)
+    if uds:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        tmp_path = f"{uds}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        sock.bind(tmp_path)
+        os.chmod(tmp_path, 0o666)
+        os.replace(tmp_path, uds)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((options.pop("host"), options.pop("port")))
+    return sock
+
+def serve(options: Dict[str, Any], sock: socket.socket):
+    """在已绑定的 socket 上运行 uvicorn
+    
+    不用 uvicorn.run(fd=...)：uvicorn 会另外复制一份 fd，退出时只关闭复制的那份，
+    原 socket 一直处于监听状态直到进程结束，drain 期间仍会分走新连接却无人 accept。
+    单进程时 socket 直接交给 Server，收到退出信号后随 Server 一起关闭；
+    多进程时各 worker 持有各自的副本，主进程收到退出信号时立即关闭自己持有的那份。
+    """
     import uvicorn
+    from uvicorn.main import STARTUP_FAILURE
+    if WORKERS > 1:
+        from uvicorn.supervisors import Multiprocess
+        # 多进程模式需以导入字符串启动，各 worker 通过 STATE 共享凭据
+        supervisor = Multiprocess(uvicorn.Config("main:app", workers=WORKERS, **options), sockets=[sock])
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(sig)
+            def handler(signum, frame, previous=previous):
+                sock.close()
+                previous(signum, frame)
+            signal.signal(sig, handler)
+        supervisor.run()
+        return
+    server = uvicorn.Server(uvicorn.Config(app, **options))
+    try:
+        server.run(sockets=[sock])
+    except KeyboardInterrupt:
+        pass
+    if not server.started:
+        sys.exit(STARTUP_FAILURE)
+
+if __name__ == "__main__":
     PORT = CONFIG.get("port", 1234)
+    server_options = build_server_options(PORT)
+    listen = f"unix:{server_options['uds']}" if "uds" in server_options else f"http://0.0.0.0:{PORT}"
+    listen_socket = bind_listen_socket(server_options)
     print(f"""
 ╔══════════════════════════════════════════════════════════╗
 ║           Antigravity API Server                         ║
+║  Workers: {WORKERS:<3}                                            ║
 ║                                                          ║
-║  端点: http://0.0.0.0:{PORT:<5}                              ║
-║  文档: http://0.0.0.0:{PORT}/docs                          ║
+║  端点: {listen:<50}║
+║  文档: {listen + "/docs":<50}║
 ║                                                          ║
 ║  使用方法:                                               ║
 ║  source start.sh                                         ║
 ║  claude                                                   ║
 ╚══════════════════════════════════════════════════════════╝
     """)
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    serve(server_options, listen_socket)
@@ -8,6 +8,8 @@ SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 CONFIG_FILE="$SCRIPT_DIR/config.json"
 REQUIREMENTS_FILE="$SCRIPT_DIR/requirements.txt"
 ENV_FILE="/root/.env"
+PID_FILE="$SCRIPT_DIR/.antigravity.pid"
+LOG_FILE="/tmp/antigravity.log"
 
 echo ""
 echo "╔══════════════════════════════════════════════════════════╗"
@@ -51,6 +53,11 @@ fi
 REFRESH_TOKEN=$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('refresh_token', ''))" 2>/dev/null)
 PORT=$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('port', 1234))" 2>/dev/null)
 DEFAULT_MODEL=$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('default_model', 'gemini-2.5-flash'))" 2>/dev/null)
+WORKERS=${ANTIGRAVITY_WORKERS:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('workers', 1))" 2>/dev/null)}
+# 服务器 profile: default / fast (可用环境变量 ANTIGRAVITY_PROFILE 覆盖)
+PROFILE=${ANTIGRAVITY_PROFILE:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('server', {}).get('profile', 'default'))" 2>/dev/null)}
+UDS=${ANTIGRAVITY_UDS:-$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('server', {}).get('uds') or '')" 2>/dev/null)}
+DRAIN_TIMEOUT=$(python3 -c "import json; print(json.load(open('$CONFIG_FILE')).get('drain', {}).get('timeout', 300))" 2>/dev/null)
 
 # 检查 refresh_token
 if [ -z "$REFRESH_TOKEN" ] || [ "$REFRESH_TOKEN" = "" ]; then
@@ -72,27 +79,85 @@ fi
 echo "[✓] Refresh Token: ${REFRESH_TOKEN:0:20}..."
 echo "[✓] 监听端口: $PORT"
 echo "[✓] 默认模型: $DEFAULT_MODEL"
+echo "[✓] Worker 数: $WORKERS"
+echo "[✓] Profile: $PROFILE"
+[ -n "$UDS" ] && echo "[✓] Unix Socket: $UDS"
 echo ""
 
-# 杀死旧进程
-echo "[*] 停止旧进程..."
-pkill -f "antigravity-API-Server/main.py" 2>/dev/null
-fuser -k $PORT/tcp 2>/dev/null
-sleep 1
+# 旧进程：新进程就绪后再发送 SIGTERM，旧进程等进行中的流式响应结束后退出
+OLD_PIDS=""
+if [ -f "$PID_FILE" ] && kill -0 "$(cat "$PID_FILE")" 2>/dev/null; then
+    OLD_PIDS=$(cat "$PID_FILE")
+elif [ -z "$UDS" ]; then
+    # 旧版本未写 PID 文件，按端口查找
+    OLD_PIDS=$(fuser $PORT/tcp 2>/dev/null)
+fi
+
+# 健康检查地址 (监听 Unix Socket 时通过 --unix-socket 访问)
+if [ -n "$UDS" ]; then
+    HEALTH_CMD=(curl -s --unix-socket "$UDS" "http://localhost/health")
+else
+    HEALTH_CMD=(curl -s "http://127.0.0.1:$PORT/health")
+fi
 
-# 启动服务
+start_server() {
+    cd "$SCRIPT_DIR"
+    ANTIGRAVITY_WORKERS=$WORKERS ANTIGRAVITY_PROFILE=$PROFILE ANTIGRAVITY_UDS=$UDS nohup python3 main.py > "$LOG_FILE" 2>&1 &
+    SERVER_PID=$!
+}
+
+# 等待新进程就绪 (预热完成前 /health 返回 warming，最多等待 60 秒)
+# 新旧进程共用端口期间应答可能来自旧进程，以 /health 返回的 pid 区分 (多 worker 时为其父进程)
+wait_healthy() {
+    local resp pid
+    for i in $(seq 1 60); do
+        resp=$("${HEALTH_CMD[@]}")
+        pid=$(echo "$resp" | grep -o '"pid":[0-9]*' | cut -d: -f2)
+        if echo "$resp" | grep -q '"ok"' && [ -n "$pid" ] && \
+           { [ "$pid" = "$SERVER_PID" ] || [ "$(ps -o ppid= -p "$pid" 2>/dev/null | tr -d ' ')" = "$SERVER_PID" ]; }; then
+            return 0
+        fi
+        # 进程已退出则不再等待
+        kill -0 $SERVER_PID 2>/dev/null || return 1
+        sleep 1
+    done
+    return 1
+}
+
+# 启动服务 (旧进程的日志转存到 .old，drain 期间继续写入)
 echo "[*] 启动 API 服务器..."
-cd "$SCRIPT_DIR"
-nohup python3 main.py > /tmp/antigravity.log 2>&1 &
-SERVER_PID=$!
+[ -n "$OLD_PIDS" ] && [ -f "$LOG_FILE" ] && mv "$LOG_FILE" "$LOG_FILE.old"
+start_server
+HEALTHY=0
+wait_healthy && HEALTHY=1
 
-# 等待启动
-sleep 3
+# 旧进程未开启端口复用 (旧版本) 时新进程无法绑定端口，先等旧进程退出再启动
+if [ $HEALTHY -eq 0 ] && [ -n "$OLD_PIDS" ] && grep -q "Address already in use" "$LOG_FILE" 2>/dev/null; then
+    echo "[*] 端口被旧进程占用，等待旧进程退出 (最多 ${DRAIN_TIMEOUT}s)..."
+    kill -TERM $OLD_PIDS 2>/dev/null
+    for i in $(seq 1 $((DRAIN_TIMEOUT + 10))); do
+        kill -0 $OLD_PIDS 2>/dev/null || break
+        sleep 1
+    done
+    kill -KILL $OLD_PIDS 2>/dev/null
+    OLD_PIDS=""
+    start_server
+    wait_healthy && HEALTHY=1
+fi
 
 # 检查是否启动成功
-if curl -s "http://127.0.0.1:$PORT/health" | grep -q "ok"; then
+if [ $HEALTHY -eq 1 ]; then
     echo "[✓] 服务器启动成功 (PID: $SERVER_PID)"
+    echo $SERVER_PID > "$PID_FILE"
+    if [ -n "$OLD_PIDS" ]; then
+        kill -TERM $OLD_PIDS 2>/dev/null
+        echo "[*] 旧进程 (PID: $OLD_PIDS) 已停止接收新请求，进行中的流式响应结束后退出 (最多 ${DRAIN_TIMEOUT}s)"
+    fi
     echo ""
+    if [ -n "$UDS" ]; then
+        echo "[!] 服务监听在 Unix Socket，ANTHROPIC_BASE_URL 仅对支持 Unix Socket 的客户端有效"
+        echo ""
+    fi
     
     # 设置当前会话环境变量
     export ANTHROPIC_BASE_URL="http://127.0.0.1:$PORT"
@@ -140,11 +205,13 @@ if curl -s "http://127.0.0.1:$PORT/health" | grep -q "ok"; then
     echo "║  现在可以直接运行: claude                                ║"
     echo "╚══════════════════════════════════════════════════════════╝"
     echo ""
-    echo "[i] 日志: tail -f /tmp/antigravity.log"
-    echo "[i] 停止: pkill -f 'antigravity-API-Server/main.py'"
+    echo "[i] 日志: tail -f $LOG_FILE"
+    echo "[i] 停止: kill \$(cat $PID_FILE)  (平滑退出，等待进行中的请求)"
     echo ""
 else
+    kill -TERM $SERVER_PID 2>/dev/null
     echo "[✗] 服务器启动失败，请检查日志:"
-    echo "    tail -50 /tmp/antigravity.log"
+    echo "    tail -50 $LOG_FILE"
+    [ -n "$OLD_PIDS" ] && echo "[i] 旧进程 (PID: $OLD_PIDS) 保持运行"
     return 1 2>/dev/null || exit 1
 fi
@@ -0,0 +1,17 @@
+"""测试环境：main 在导入时读取配置并打开 state_db，导入前改用临时目录中的配置"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="antigravity-test-")
+with open(os.path.join(ROOT, "config.json")) as f:
+    _config = json.load(f)
+_config.update({"state_db": os.path.join(_workdir, "state.db"), "workers": 1})
+_config_path = os.path.join(_workdir, "config.json")
+with open(_config_path, "w") as f:
+    json.dump(_config, f)
+os.environ["ANTIGRAVITY_CONFIG"] = _config_path
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+def sse(text: str, usage: bool = False) -> bytes:
+    chunk = {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+    if usage:
+        chunk["usageMetadata"] = {"promptTokenCount": 7, "candidatesTokenCount": 2}
+    return f"data: {json.dumps({'response': chunk})}\n\n".encode()
+
+class Stalled(httpx.AsyncByteStream):
+    """发出一个分块后停住：MockTransport 不计读超时，直接抛出空闲超时时 httpx 会抛的 ReadTimeout"""
+    async def __aiter__(self):
+        yield sse("a")
+        raise httpx.ReadTimeout("idle")
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """把上游替换为 MockTransport，handler 由测试设置"""
+    state = {"handler": None}
+    transport = httpx.MockTransport(lambda request: state["handler"](request))
+    monkeypatch.setattr(main, "_http_client", httpx.AsyncClient(transport=transport))
+    monkeypatch.setattr(main, "ENDPOINTS", [main.Endpoint("https://a.example/v1internal"),
+                                            main.Endpoint("https://b.example/v1internal")])
+    monkeypatch.setitem(main.STREAM_AGGREGATE, "enabled", True)
+    monkeypatch.setitem(main.STREAM_AGGREGATE, "retries", 1)
+    return state
+
+def aggregate():
+    return asyncio.run(main.aggregate_upstream(b"{}", {}, "claude-test", main.StageTimer()))
+
+def test_malformed_data_line_is_skipped(upstream):
+    body = sse("a") + b"data: {not json\n\n" + sse("b", usage=True)
+    upstream["handler"] = lambda request: httpx.Response(200, content=body)
+    status, result = aggregate()
+    assert status == 200
+    assert result["content"] == [{"type": "text", "text": "ab"}]
+    assert result["usage"] == {"input_tokens": 7, "output_tokens": 2}
+
+def test_exhausted_retries_return_gateway_timeout(upstream):
+    upstream["handler"] = lambda request: httpx.Response(200, stream=Stalled())
+    status, result = aggregate()
+    assert status == 504
+    assert "ReadTimeout" in result
+
+def test_exhausted_retries_on_transport_error_return_bad_gateway(upstream):
+    def handler(request):
+        raise httpx.ConnectError("refused")
+    upstream["handler"] = handler
+    status, result = aggregate()
+    assert status == 502
+    assert "ConnectError" in result
+
+def test_messages_reports_aggregate_failure(upstream, monkeypatch):
+    upstream["handler"] = lambda request: httpx.Response(200, stream=Stalled())
+    recorded = []
+    monkeypatch.setattr(main.USAGE_LOG, "record", lambda *args, **kwargs: recorded.append(kwargs))
+
+    async def token():
+        return "token"
+
+    async def project():
+        return "project"
+
+    monkeypatch.setattr(main, "get_access_token", token)
+    monkeypatch.setattr(main, "get_project_id", project)
+    # 不经 lifespan，避免预热与后台任务访问上游
+    client = TestClient(main.app)
+    resp = client.post("/v1/messages", json={"model": "gemini-2.5-flash",
+                                             "messages": [{"role": "user", "content": "hi"}]})
+    assert resp.status_code == 504
+    assert "timed out" in resp.json()["detail"]
+    assert recorded == [{"error": True}]
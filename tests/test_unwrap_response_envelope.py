@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import main
+
+INNER = '{"candidates": [{"content": {"parts": [{"text": "a}, \\"k\\": {}"}]}}]}'
+USAGE_INNER = '{"candidates": [], "usageMetadata": {"promptTokenCount": 3, "candidatesTokenCount": 1}}'
+
+@pytest.mark.parametrize("text", [
+    '{"response": %s}' % INNER,
+    ' {"response" : %s } \n' % INNER,
+    '{"response": %s, "traceId": "t"}' % INNER,
+    '{"response": %s, "traceId": "t", "metadata": {}}' % INNER,
+    '{"response": %s, "metadata": {"a": {"b": 1}}}' % INNER,
+    '{"response": %s, "x": {"y": {}}}' % INNER,
+    '{"response": %s, "x": [[1]], "t": "s"}' % INNER,
+])
+def test_first_key_envelope_is_sliced_verbatim(text):
+    inner, usage = main.unwrap_response_envelope(text)
+    assert inner == INNER
+    assert usage == {}
+
+@pytest.mark.parametrize("text", [
+    '{"traceId": "t", "response": %s}' % INNER,
+    '{"metadata": {"a": {"b": 1}}, "response": %s, "traceId": "t"}' % INNER,
+])
+def test_envelope_with_response_not_first_is_unwrapped(text):
+    inner, usage = main.unwrap_response_envelope(text)
+    assert json.loads(inner) == json.loads(INNER)
+    assert usage == {}
+
+def test_usage_metadata_is_returned():
+    inner, usage = main.unwrap_response_envelope('{"response": %s, "traceId": "t"}' % USAGE_INNER)
+    assert inner == USAGE_INNER
+    assert usage == {"promptTokenCount": 3, "candidatesTokenCount": 1}
+
+@pytest.mark.parametrize("text", [INNER, USAGE_INNER, '{"candidates": [{"content": {"parts": [{"text": "\\"response\\""}]}}]}'])
+def test_unwrapped_chunk_is_returned_as_is(text):
+    inner, usage = main.unwrap_response_envelope(text)
+    assert inner == text
+    assert usage == (json.loads(text).get("usageMetadata") or {})
+
+@pytest.mark.parametrize("text", [
+    '{"response": {"usageMetadata": ',
+    '{"response": garbage}',
+    '{"response": {"a": 1} "traceId": "t"}',
+    '{"response": ',
+    '{"traceId": "t", "response": ',
+])
+def test_unparseable_text_raises_value_error(text):
+    with pytest.raises(ValueError):
+        main.unwrap_response_envelope(text)